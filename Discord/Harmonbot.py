@@ -8,6 +8,7 @@ if __name__ == "__main__":
 	import asyncio
 	import ctypes
 	import datetime
+	import json
 	import os
 	import re
 	import sys
@@ -49,39 +50,21 @@ if __name__ == "__main__":
 		guild = message.guild
 		
 		# Log message
+		embeds = [json.dumps(replace_null_character(embed.to_dict())) for embed in message.embeds]
 		if channel.type is discord.ChannelType.private:
-			await ctx.bot.db.execute(
-				"""
-				INSERT INTO chat.messages (
-					created_at, message_id, 
-					author_id, author_name, author_discriminator, author_display_name, 
-					direct_message, 
-					message_content, embeds
-				)
-				VALUES ($1, $2, $3, $4, $5, $6, TRUE, $7, CAST($8 AS jsonb[]))
-				""", 
+			await ctx.bot.chat_message_writer.add((
 				message.created_at.replace(tzinfo = datetime.timezone.utc), message.id, 
 				author.id, author.name, author.discriminator, author.display_name, 
-				message.content.replace('\N{NULL}', ""), 
-				[replace_null_character(embed.to_dict()) for embed in message.embeds]
-			)
+				True, None, None, None, None, 
+				message.content.replace('\N{NULL}', ""), embeds
+			))
 		else:
-			await ctx.bot.db.execute(
-				"""
-				INSERT INTO chat.messages (
-					created_at, message_id, 
-					author_id, author_name, author_discriminator, author_display_name, 
-					direct_message, channel_id, channel_name, guild_id, guild_name, 
-					message_content, embeds
-				)
-				VALUES ($1, $2, $3, $4, $5, $6, FALSE, $7, $8, $9, $10, $11, CAST($12 AS jsonb[]))
-				""", 
+			await ctx.bot.chat_message_writer.add((
 				message.created_at.replace(tzinfo = datetime.timezone.utc), message.id, 
 				author.id, author.name, author.discriminator, author.display_name, 
-				channel.id, channel.name, guild.id, guild.name, 
-				message.content.replace('\N{NULL}', ""), 
-				[replace_null_character(embed.to_dict()) for embed in message.embeds]
-			)
+				False, channel.id, channel.name, guild.id, guild.name, 
+				message.content.replace('\N{NULL}', ""), embeds
+			))
 		
 		# Server specific settings
 		if guild is not None:
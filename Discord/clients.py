@@ -31,9 +31,10 @@ from wordnik import swagger, WordApi, WordsApi
 import youtube_dl
 
 from utilities.audio_player import AudioPlayer
+from utilities.audio_sources import AudioCache
 from utilities import errors
 from utilities.context import Context
-from utilities.database import create_database_pool
+from utilities.database import BatchedRecordWriter, BufferedCounter, create_database_pool
 from utilities.help_command import HelpCommand
 from utilities.logging import AiohttpAccessLogger, initialize_aiohttp_access_logging, initialize_logging
 
@@ -66,6 +67,8 @@ class Bot(commands.Bot):
 								"with Voyager 1", "with Waste Allocation Load Lifter: Earth-Class", "world domination", 
 								"with Clyde")
 		self.stream_url = "https://www.twitch.tv/harmonbot"
+		# Cross-process prefix cache invalidation with PostgreSQL LISTEN/NOTIFY
+		self.prefix_notifications = False
 		
 		# Initialize logging
 		initialize_logging(self.data_path)
@@ -130,6 +133,11 @@ class Bot(commands.Bot):
 		self.loop.create_task(self.initialize_constant_objects(), name = "Initialize Discord objects as constant attributes of Bot")
 		
 		# Variables
+		self.direct_message_prefixes = {}
+		self.guild_permissions = {}
+		# Incremented when a guild's permissions change, to discard retrievals in progress
+		self.guild_permissions_generations = {}
+		self.guild_prefixes = {}
 		self.guild_settings = {}
 		self.online_time = datetime.datetime.now(datetime.timezone.utc)
 		self.session_commands_invoked = {}
@@ -184,8 +192,9 @@ class Bot(commands.Bot):
 			self.print(f"Failed to initialize Wordnik Client: {e}")
 		## youtube-dl
 		self.ytdl_download_options = {"default_search": "auto", "noplaylist": True, "quiet": True, "format": "bestaudio/best", "extractaudio": True, 
-										"outtmpl": self.data_path + "/audio_cache/%(id)s-%(title)s.%(ext)s", "restrictfilenames": True}  # "audioformat": "mp3" ?
+										"outtmpl": self.data_path + "/audio_cache/%(extractor_key)s-%(id)s.%(ext)s", "restrictfilenames": True}  # "audioformat": "mp3" ?
 		self.ytdl_download = youtube_dl.YoutubeDL(self.ytdl_download_options)
+		self.audio_cache = AudioCache(self.data_path + "/audio_cache")
 		self.ytdl_info_options = {"default_search": "auto", "noplaylist": True, "quiet": True, "format": "webm[abr>0]/bestaudio/best", "prefer_ffmpeg": True}
 		self.ytdl_info = youtube_dl.YoutubeDL(self.ytdl_info_options)
 		self.ytdl_playlist_options = {"default_search": "auto", "ignoreerrors": True, "quiet": True, "format": "webm[abr>0]/bestaudio/best", "prefer_ffmpeg": True}
@@ -235,6 +244,16 @@ class Bot(commands.Bot):
 		self.connected_to_database = asyncio.Event()
 		self.connected_to_database.set()
 		self.loop.run_until_complete(self.initialize_database())
+		self.chat_message_writer = BatchedRecordWriter(self.write_chat_messages, name = "chat messages")
+		self.chat_message_writer.start(self.loop)
+		self.command_invocation_counter = BufferedCounter(self.write_command_invocation_counts, 
+															name = "command invocation counts")
+		self.command_invocation_counter.start(self.loop)
+		# Tasks writing buffered data for unloaded cogs
+		self.unload_writes = set()
+		self.prefix_notifications_connection = None
+		if self.prefix_notifications:
+			self.loop.run_until_complete(self.listen_for_prefix_notifications())
 		
 		# HTTP Web Server
 		self.loop.run_until_complete(initialize_aiohttp_access_logging(self.database))
@@ -425,6 +444,62 @@ class Bot(commands.Bot):
 			)
 			"""
 		)
+		await self.load_prefixes()
+	
+	async def load_prefixes(self):
+		self.direct_message_prefixes = {
+			record["channel_id"]: record["prefixes"]
+			for record in await self.db.fetch("SELECT * FROM direct_messages.prefixes")
+		}
+		self.guild_prefixes = {
+			record["guild_id"]: record["prefixes"]
+			for record in await self.db.fetch("SELECT * FROM guilds.prefixes")
+		}
+	
+	async def listen_for_prefix_notifications(self):
+		self.prefix_notifications_connection = await self.database_connection_pool.acquire()
+		await self.prefix_notifications_connection.add_listener("prefixes", self.on_prefix_notification)
+	
+	def on_prefix_notification(self, connection, pid, channel, payload):
+		data = json.loads(payload)
+		if "channel_id" in data:
+			self.direct_message_prefixes[data["channel_id"]] = data["prefixes"]
+		else:
+			self.guild_prefixes[data["guild_id"]] = data["prefixes"]
+	
+	async def set_direct_message_prefixes(self, channel_id, prefixes):
+		await self.db.execute(
+			"""
+			INSERT INTO direct_messages.prefixes (channel_id, prefixes)
+			VALUES ($1, $2)
+			ON CONFLICT (channel_id) DO
+			UPDATE SET prefixes = $2
+			""", 
+			channel_id, prefixes
+		)
+		self.direct_message_prefixes[channel_id] = list(prefixes)
+		if self.prefix_notifications:
+			await self.db.execute(
+				"SELECT pg_notify('prefixes', $1)", 
+				json.dumps({"channel_id": channel_id, "prefixes": list(prefixes)})
+			)
+	
+	async def set_guild_prefixes(self, guild_id, prefixes):
+		await self.db.execute(
+			"""
+			INSERT INTO guilds.prefixes (guild_id, prefixes)
+			VALUES ($1, $2)
+			ON CONFLICT (guild_id) DO
+			UPDATE SET prefixes = $2
+			""", 
+			guild_id, prefixes
+		)
+		self.guild_prefixes[guild_id] = list(prefixes)
+		if self.prefix_notifications:
+			await self.db.execute(
+				"SELECT pg_notify('prefixes', $1)", 
+				json.dumps({"guild_id": guild_id, "prefixes": list(prefixes)})
+			)
 	
 	async def web_server_get_handler(self, request):
 		'''
@@ -560,35 +635,43 @@ class Bot(commands.Bot):
 	# TODO: on_command_completion
 	async def on_command(self, ctx):
 		self.session_commands_invoked[ctx.command.name] = self.session_commands_invoked.get(ctx.command.name, 0) + 1
-		await self.db.execute(
-			"""
-			UPDATE meta.stats
-			SET commands_invoked = commands_invoked + 1
-			WHERE timestamp = $1
-			""", 
-			self.online_time
-		)
-		await self.db.execute(
-			"""
-			INSERT INTO meta.commands_invoked (command, invokes)
-			VALUES ($1, 1)
-			ON CONFLICT (command) DO
-			UPDATE SET invokes = commands_invoked.invokes + 1
-			""", 
-			ctx.command.name
-		)
 		# TODO: Handle subcommand names
-		await self.db.execute(
-			"""
-			INSERT INTO users.stats (user_id, commands_invoked)
-			VALUES ($1, 1)
-			ON CONFLICT (user_id) DO
-			UPDATE SET commands_invoked = stats.commands_invoked + 1
-			""", 
-			ctx.author.id
-		)
+		self.command_invocation_counter.increment(("command", ctx.command.name))
+		self.command_invocation_counter.increment(("user", ctx.author.id))
 		# TODO: Track names
 	
+	async def write_command_invocation_counts(self, counts):
+		commands_invoked = {key: count for (counter_type, key), count in counts.items() if counter_type == "command"}
+		users_commands_invoked = {key: count for (counter_type, key), count in counts.items() if counter_type == "user"}
+		async with self.database_connection_pool.acquire() as connection:
+			async with connection.transaction():
+				await connection.execute(
+					"""
+					UPDATE meta.stats
+					SET commands_invoked = commands_invoked + $2
+					WHERE timestamp = $1
+					""", 
+					self.online_time, sum(commands_invoked.values())
+				)
+				await connection.execute(
+					"""
+					INSERT INTO meta.commands_invoked (command, invokes)
+					SELECT * FROM UNNEST($1::TEXT[], $2::BIGINT[])
+					ON CONFLICT (command) DO
+					UPDATE SET invokes = commands_invoked.invokes + EXCLUDED.invokes
+					""", 
+					list(commands_invoked.keys()), list(commands_invoked.values())
+				)
+				await connection.execute(
+					"""
+					INSERT INTO users.stats (user_id, commands_invoked)
+					SELECT * FROM UNNEST($1::BIGINT[], $2::INT[])
+					ON CONFLICT (user_id) DO
+					UPDATE SET commands_invoked = stats.commands_invoked + EXCLUDED.commands_invoked
+					""", 
+					list(users_commands_invoked.keys()), list(users_commands_invoked.values())
+				)
+	
 	async def on_command_error(self, ctx, error):
 		# Ignore
 		## Not owner
@@ -678,6 +761,10 @@ class Bot(commands.Bot):
 	
 	async def on_message_edit(self, before, after):
 		if after.edited_at != before.edited_at:
+			# Write the message first if it's buffered or being written, as edits are only logged for logged messages
+			if (self.chat_message_writer.flush_lock.locked() or 
+				any(record[1] == after.id for record in self.chat_message_writer.buffer)):
+				await self.chat_message_writer.flush()
 			if before.content != after.content:
 				await self.db.execute(
 					"""
@@ -704,6 +791,42 @@ class Bot(commands.Bot):
 					after.edited_at.replace(tzinfo = datetime.timezone.utc), after.id, before_embeds, after_embeds
 				)
 	
+	async def write_chat_messages(self, records):
+		async with self.database_connection_pool.acquire() as connection:
+			async with connection.transaction():
+				# Embeds are copied as JSON text, as COPY requires binary codecs
+				await connection.execute(
+					"""
+					CREATE TEMPORARY TABLE chat_messages_buffer (
+						created_at				TIMESTAMPTZ, 
+						message_id				BIGINT, 
+						author_id				BIGINT, 
+						author_name				TEXT, 
+						author_discriminator	TEXT, 
+						author_display_name		TEXT, 
+						direct_message			BOOL, 
+						channel_id				BIGINT, 
+						channel_name			TEXT, 
+						guild_id				BIGINT, 
+						guild_name				TEXT, 
+						message_content			TEXT, 
+						embeds					TEXT []
+					) ON COMMIT DROP
+					"""
+				)
+				await connection.copy_records_to_table("chat_messages_buffer", records = records)
+				await connection.execute(
+					"""
+					INSERT INTO chat.messages
+					SELECT created_at, message_id, 
+						author_id, author_name, author_discriminator, author_display_name, 
+						direct_message, channel_id, channel_name, guild_id, guild_name, 
+						message_content, CAST(embeds AS jsonb[])
+					FROM chat_messages_buffer
+					ON CONFLICT (message_id) DO NOTHING
+					"""
+				)
+	
 	async def increment_menu_reactions_count(self):
 		await self.db.execute(
 			"""
@@ -797,6 +920,44 @@ class Bot(commands.Bot):
 		)
 		self.guild_settings.setdefault(guild_id, {})[name] = setting
 	
+	async def get_guild_permissions(self, guild_id):
+		if guild_id in self.guild_permissions:
+			return self.guild_permissions[guild_id]
+		return await self.retrieve_guild_permissions(guild_id)
+	
+	def invalidate_guild_permissions(self, guild_id):
+		self.guild_permissions.pop(guild_id, None)
+		self.guild_permissions_generations[guild_id] = self.guild_permissions_generations.get(guild_id, 0) + 1
+	
+	async def retrieve_guild_permissions(self, guild_id):
+		guild_permissions = {"everyone": {}, "roles": {}, "users": {}}
+		generation = self.guild_permissions_generations.get(guild_id, 0)
+		records = await self.db.fetch(
+			"""
+			SELECT 'everyone' AS type, NULL::BIGINT AS id, permission, setting
+			FROM permissions.everyone
+			WHERE guild_id = $1
+			UNION ALL
+			SELECT 'roles', role_id, permission, setting
+			FROM permissions.roles
+			WHERE guild_id = $1
+			UNION ALL
+			SELECT 'users', user_id, permission, setting
+			FROM permissions.users
+			WHERE guild_id = $1
+			""", 
+			guild_id
+		)
+		for record in records:
+			if record["type"] == "everyone":
+				guild_permissions["everyone"][record["permission"]] = record["setting"]
+			else:
+				guild_permissions[record["type"]][(record["id"], record["permission"])] = record["setting"]
+		# Don't cache permissions that may have changed during retrieval
+		if self.guild_permissions_generations.get(guild_id, 0) == generation:
+			self.guild_permissions[guild_id] = guild_permissions
+		return guild_permissions
+	
 	# Update stats on sites listing Discord bots
 	async def update_listing_stats(self, site):
 		site = self.listing_sites.get(site)
@@ -866,6 +1027,20 @@ class Bot(commands.Bot):
 			""", 
 			self.online_time, uptime
 		)
+		# Stop web server
+		await self.aiohttp_app_runner.cleanup()
+		# Write buffered chat messages, command invocation counts, and aiohttp access log records
+		await self.chat_message_writer.close()
+		await self.command_invocation_counter.close()
+		await AiohttpAccessLogger.record_writer.close()
+		# Write buffered respects, if the cog wasn't unloaded
+		if respects_cog := self.get_cog("Respects"):
+			await respects_cog.counter.close()
+		# Wait for unloaded cogs to write their buffered data
+		await asyncio.gather(*self.unload_writes)
+		# Stop listening for prefix notifications
+		if self.prefix_notifications_connection:
+			await self.database_connection_pool.release(self.prefix_notifications_connection)
 		# Close Sentry transport
 		sentry_transport = self.sentry_client.remote.get_transport()
 		if sentry_transport:
@@ -874,8 +1049,6 @@ class Bot(commands.Bot):
 		await self.aiohttp_session.close()
 		# Close database connection
 		await self.database_connection_pool.close()
-		# Stop web server
-		await self.aiohttp_app_runner.cleanup()
 	
 	@commands.group(invoke_without_command = True, case_insensitive = True)
 	@commands.is_owner()
@@ -975,23 +1148,10 @@ def create_file(filename, content = None, filetype = "json"):
 		pass  # TODO: Handle?
 
 async def get_prefix(bot, message):
+	# Prefixes are cached by Bot.load_prefixes and Bot.set_*_prefixes
 	if message.channel.type is discord.ChannelType.private:
-		prefixes = await bot.db.fetchval(
-			"""
-			SELECT prefixes
-			FROM direct_messages.prefixes
-			WHERE channel_id = $1
-			""", 
-			message.channel.id
-		)
+		prefixes = bot.direct_message_prefixes.get(message.channel.id)
 	else:
-		prefixes = await bot.db.fetchval(
-			"""
-			SELECT prefixes
-			FROM guilds.prefixes
-			WHERE guild_id = $1
-			""", 
-			message.guild.id
-		)
+		prefixes = bot.guild_prefixes.get(message.guild.id)
 	return prefixes if prefixes else '!'
 
@@ -340,6 +340,38 @@ class Audio(commands.Cog):
 		self.players[ctx.guild.id].text_channel = ctx.channel
 		await ctx.embed_reply(":writing_hand::skin-tone-2: Changed text channel")
 	
+	@commands.group(invoke_without_command = True, case_insensitive = True)
+	@checks.is_voice_connected()
+	@commands.check_any(checks.is_permitted(), checks.is_guild_owner())
+	async def streaming(self, ctx):
+		'''
+		Stream songs instead of downloading them before playing
+		Streamed songs start sooner, and are still downloaded to the cache in the background
+		No input to turn on/off
+		'''
+		if self.players[ctx.guild.id].stream_songs:
+			await ctx.invoke(self.streaming_off)
+		else:
+			await ctx.invoke(self.streaming_on)
+	
+	@streaming.command(name = "on", aliases = ["start"])
+	@checks.is_voice_connected()
+	@commands.check_any(checks.is_permitted(), checks.is_guild_owner())
+	async def streaming_on(self, ctx):
+		'''Stream songs'''
+		self.players[ctx.guild.id].stream_songs = True
+		self.players[ctx.guild.id].update_prefetches()
+		await ctx.embed_reply(":satellite: Songs will be streamed")
+	
+	@streaming.command(name = "off", aliases = ["stop"])
+	@checks.is_voice_connected()
+	@commands.check_any(checks.is_permitted(), checks.is_guild_owner())
+	async def streaming_off(self, ctx):
+		'''Download songs before playing them'''
+		self.players[ctx.guild.id].stream_songs = False
+		self.players[ctx.guild.id].update_prefetches()
+		await ctx.embed_reply(":arrow_down: Songs will be downloaded before playing")
+	
 	@commands.group(invoke_without_command = True, case_insensitive = True)
 	@checks.is_voice_connected()
 	@commands.check_any(checks.is_permitted(), checks.is_guild_owner())
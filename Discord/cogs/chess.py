@@ -3,10 +3,14 @@ import discord
 from discord.ext import commands
 
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import io
 import random
 import subprocess
+import sys
 from typing import Union
 
 import chess
@@ -37,18 +41,135 @@ try:
 	# BMI2 >= AVX2 > SSE4.1 + POPCNT (modern) >= SSSE3 > none
 	# https://stockfishchess.org/download/
 	# TODO: Handle 32-bit?
-	# TODO: Handle not Windows?
 except:
 	pass
-STOCKFISH_EXECUTABLE += ".exe"
+if sys.platform == "win32":
+	STOCKFISH_EXECUTABLE += ".exe"
+	ENGINE_POPEN_ARGS = {"creationflags": subprocess.CREATE_NO_WINDOW}
+else:
+	ENGINE_POPEN_ARGS = {}
 
 def setup(bot):
-	bot.add_cog(ChessCog())
+	bot.add_cog(ChessCog(bot))
+
+def render_board(board_fen, orientation, lastmove, check):
+	'''Render board as PNG, in a worker process'''
+	board = chess.BaseBoard(board_fen)
+	lastmove = chess.Move.from_uci(lastmove) if lastmove else None
+	svg = chess.svg.board(board, lastmove = lastmove, check = check, orientation = orientation)
+	buffer = io.BytesIO()
+	with Image(blob = svg.encode()) as image:
+		image.format = "PNG"
+		image.save(file = buffer)
+	return buffer.getvalue()
+
+class EnginePool:
+	
+	'''
+	Bounded pool of long-lived UCI engines
+	Engines are started as needed, up to size, and leased for each analysis
+	Crashed and unresponsive engines are replaced
+	'''
+	
+	def __init__(self, command, size = 2, ping_timeout = 10):
+		self.command = command
+		self.size = size
+		self.ping_timeout = ping_timeout
+		self.idle = asyncio.Queue()
+		self.engines = set()
+		self.closed = False
+	
+	async def start_engine(self):
+		transport, engine = await chess.engine.popen_uci(self.command, **ENGINE_POPEN_ARGS)
+		self.engines.add(engine)
+		return engine
+	
+	async def acquire(self):
+		while True:
+			if not self.idle.empty():
+				engine = self.idle.get_nowait()
+			elif len(self.engines) < self.size:
+				engine = None
+			else:
+				engine = await self.idle.get()
+			if engine is None:
+				# None is queued when a slot is freed, to wake a waiter to start a new engine
+				if len(self.engines) >= self.size:
+					continue
+				# Reserve the slot while the engine starts
+				placeholder = object()
+				self.engines.add(placeholder)
+				try:
+					engine = await self.start_engine()
+				except BaseException:
+					self.free_slot()
+					raise
+				finally:
+					self.engines.discard(placeholder)
+				return engine
+			if await self.healthy(engine):
+				return engine
+			await self.discard(engine)
+	
+	async def healthy(self, engine):
+		if engine.returncode.done():
+			return False
+		try:
+			await asyncio.wait_for(engine.ping(), timeout = self.ping_timeout)
+		except (asyncio.TimeoutError, chess.engine.EngineError, chess.engine.EngineTerminatedError):
+			return False
+		return True
+	
+	def release(self, engine):
+		if self.closed:
+			asyncio.ensure_future(self.discard(engine))
+		else:
+			# Crashed engines are replaced when next acquired
+			self.idle.put_nowait(engine)
+	
+	def free_slot(self):
+		if not self.closed:
+			self.idle.put_nowait(None)
+	
+	async def discard(self, engine):
+		if engine in self.engines:
+			self.engines.discard(engine)
+			self.free_slot()
+		if not engine.returncode.done():
+			try:
+				await asyncio.wait_for(engine.quit(), timeout = self.ping_timeout)
+			except (asyncio.TimeoutError, chess.engine.EngineError, chess.engine.EngineTerminatedError):
+				engine.transport.kill()
+	
+	@contextlib.asynccontextmanager
+	async def lease(self):
+		engine = await self.acquire()
+		try:
+			yield engine
+		except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+			await self.discard(engine)
+			raise
+		finally:
+			if engine in self.engines:
+				self.release(engine)
+	
+	async def close(self):
+		self.closed = True
+		while not self.idle.empty():
+			if engine := self.idle.get_nowait():
+				await self.discard(engine)
 
 class ChessCog(commands.Cog, name = "Chess"):
 	
-	def __init__(self):
+	def __init__(self, bot):
+		self.bot = bot
 		self.matches = []
+		self.engine_pool = EnginePool(f"bin/{STOCKFISH_EXECUTABLE}")
+		self.render_pool = concurrent.futures.ProcessPoolExecutor(max_workers = 2)
+		# Board image URLs, by board FEN, orientation, last move, and check square
+		self.board_image_urls = collections.OrderedDict()
+		self.board_image_urls_max_size = 4096
+		self.board_image_uploads = {}
 	
 	async def cog_check(self, ctx):
 		return await checks.not_forbidden().predicate(ctx)
@@ -57,6 +178,32 @@ class ChessCog(commands.Cog, name = "Chess"):
 		# TODO: Persistence - store running chess matches and add way to continue previous ones
 		for match in self.matches:
 			match.task.cancel()
+		self.bot.loop.create_task(self.engine_pool.close(), name = "Close chess engine pool")
+		self.render_pool.shutdown(wait = False)
+	
+	async def get_board_image_url(self, board, *, lastmove, check, orientation):
+		'''
+		Get URL for image of board, rendering and uploading it if not cached
+		Concurrent requests for the same image share a render and upload
+		'''
+		key = (board.board_fen(), orientation, lastmove.uci() if lastmove else None, check)
+		if url := self.board_image_urls.get(key):
+			self.board_image_urls.move_to_end(key)
+			return url
+		if key not in self.board_image_uploads:
+			self.board_image_uploads[key] = self.bot.loop.create_task(self.upload_board_image(key), 
+																		name = "Upload chess board image")
+			self.board_image_uploads[key].add_done_callback(lambda _: self.board_image_uploads.pop(key, None))
+		return await asyncio.shield(self.board_image_uploads[key])
+	
+	async def upload_board_image(self, key):
+		png = await self.bot.loop.run_in_executor(self.render_pool, render_board, *key)
+		image_message = await self.bot.cache_channel.send(file = discord.File(io.BytesIO(png), filename = "chess_board.png"))
+		url = image_message.attachments[0].url
+		self.board_image_urls[key] = url
+		if len(self.board_image_urls) > self.board_image_urls_max_size:
+			self.board_image_urls.popitem(last = False)
+		return url
 	
 	@commands.group(name = "chess", invoke_without_command = True, case_insensitive = True)
 	async def chess_command(self, ctx):
@@ -132,7 +279,7 @@ class ChessCog(commands.Cog, name = "Chess"):
 				return await ctx.send(f"{ctx.author.mention}: {opponent} has declined your challenge")
 			if message.content.lower() in ("no", 'n'):
 				return await ctx.send(f"{ctx.author.mention}: {opponent} has declined your challenge")
-		match = await ChessMatch.start(ctx, white_player, black_player)
+		match = await ChessMatch.start(ctx, white_player, black_player, self.engine_pool)
 		self.matches.append(match)
 		await match.ended.wait()
 		self.matches.remove(match)
@@ -230,15 +377,15 @@ class ChessCog(commands.Cog, name = "Chess"):
 class ChessMatch(chess.Board):
 	
 	@classmethod
-	async def start(cls, ctx, white_player, black_player):
+	async def start(cls, ctx, white_player, black_player, engine_pool):
 		self = cls()
 		self.ctx = ctx
 		self.white_player = white_player
 		self.black_player = black_player
 		self.bot = ctx.bot
 		self.ended = asyncio.Event()
-		self.engine_transport, self.chess_engine = await chess.engine.popen_uci(f"bin/{STOCKFISH_EXECUTABLE}", 
-																				creationflags = subprocess.CREATE_NO_WINDOW)
+		self.engine_pool = engine_pool
+		self.cog = ctx.cog
 		self.match_message = None
 		self.task = ctx.bot.loop.create_task(self.match_task(), name = "Chess Match")
 		return self
@@ -271,7 +418,9 @@ class ChessMatch(chess.Board):
 			embed = self.match_message.embeds[0]
 			if player == self.bot.user:
 				await self.match_message.edit(embed = embed.set_footer(text = "I'm thinking.."))
-				result = await self.chess_engine.play(self, chess.engine.Limit(time = 2))
+				async with self.engine_pool.lease() as engine:
+					# Passing the match as the game sends ucinewgame when the engine was last used for another match
+					result = await engine.play(self, chess.engine.Limit(time = 2), game = self)
 				self.push(result.move)
 				await self.update_match_embed(footer_text = f"I moved {result.move}")
 			else:
@@ -310,19 +459,10 @@ class ChessMatch(chess.Board):
 		chess_pgn.headers["White"] = self.white_player.mention
 		chess_pgn.headers["Black"] = self.black_player.mention
 		embed.description = str(chess_pgn)
-		## svg = self._repr_svg_()
-		svg = chess.svg.board(self, lastmove = lastmove, check = check, orientation = orientation)
-		buffer = io.BytesIO()
-		with Image(blob = svg.encode()) as image:
-			image.format = "PNG"
-			## image.save(filename = self.bot.data_path + "/temp/chess_board.png")
-			image.save(file = buffer)
-		buffer.seek(0)
 		# TODO: Upload into embed + delete and re-send to update?
-		## embed.set_image(url = self.bot.imgur_client.upload_from_path(self.bot.data_path + "/temp/chess_board.png")["link"])
-		## embed.set_image(url = data["data"]["img_url"])
-		image_message = await self.bot.cache_channel.send(file = discord.File(buffer, filename = "chess_board.png"))
-		embed.set_image(url = image_message.attachments[0].url)
+		image_url = await self.cog.get_board_image_url(self, lastmove = lastmove, check = check, 
+														orientation = orientation)
+		embed.set_image(url = image_url)
 		embed.set_footer(text = footer_text)
 		if self.match_message:
 			await self.match_message.edit(embed = embed)
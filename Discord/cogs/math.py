@@ -3,23 +3,68 @@ import discord
 from discord.ext import commands
 
 import asyncio
-import concurrent.futures
+import collections
 import math
-import multiprocessing
 
 import sympy
 
 from utilities import checks
+from utilities.workers import WorkerError, WorkerPool
 
 def setup(bot):
 	bot.add_cog(Math())
 
+def evaluate(expression):
+	'''Evaluate expression without builtins, in a worker process'''
+	return eval(expression, {"__builtins__": {}, "math": math})
+
+def differentiate_equation(equation):
+	'''Differentiate equation with respect to x, in a worker process'''
+	return str(sympy.diff(equation, sympy.symbols('x')))
+
+def integrate_equation(equation, lower_limit = None, upper_limit = None):
+	'''Integrate equation with respect to x, in a worker process'''
+	x = sympy.symbols('x')
+	if lower_limit is None:
+		return str(sympy.integrate(equation, x))
+	return str(sympy.integrate(equation, (x, lower_limit, upper_limit)))
+
 class Math(commands.Cog):
 	
 	'''
 	Also see Matrix category
 	'''
 	
+	def __init__(self):
+		self.calculation_pool = WorkerPool(2, memory_limit = 512 * 2 ** 20)
+		self.calculation_pool.start()
+		self.sympy_pool = WorkerPool(2, memory_limit = 2 ** 30)
+		self.sympy_pool.start()
+		self.sympy_timeout = 30.0
+		# Results, by function and normalized arguments
+		self.sympy_results = collections.OrderedDict()
+		self.sympy_results_max_size = 1024
+	
+	def cog_unload(self):
+		self.calculation_pool.close()
+		self.sympy_pool.close()
+	
+	async def compute_symbolic(self, func, *args):
+		'''
+		Run sympy function in the sympy worker pool, memoizing results
+		Arguments are normalized by stripping code block backticks and collapsing whitespace
+		'''
+		args = tuple(' '.join(arg.strip('`').split()) for arg in args)
+		key = (func.__name__, args)
+		if (result := self.sympy_results.get(key)) is not None:
+			self.sympy_results.move_to_end(key)
+			return result
+		result = await self.sympy_pool.run(self.sympy_timeout, func, *args)
+		self.sympy_results[key] = result
+		if len(self.sympy_results) > self.sympy_results_max_size:
+			self.sympy_results.popitem(last = False)
+		return result
+	
 	async def cog_check(self, ctx):
 		return await checks.not_forbidden().predicate(ctx)
 	
@@ -43,23 +88,24 @@ class Math(commands.Cog):
 		# TODO: use filter
 		equation = "".join(character for character in equation if character in allowed)
 		print("Calculated " + equation)
-		with multiprocessing.Pool(1) as pool:
-			async_result = pool.apply_async(eval, (equation,))
-			future = ctx.bot.loop.run_in_executor(None, async_result.get, 10.0)
-			try:
-				result = await asyncio.wait_for(future, 10.0)
-				await ctx.embed_reply(f"{equation} = {result}")
-			except discord.HTTPException:
-				# TODO: use textwrap/paginate
-				await ctx.embed_reply(":no_entry: Output too long")
-			except SyntaxError:
-				await ctx.embed_reply(":no_entry: Syntax error")
-			except TypeError as e:
-				await ctx.embed_reply(f":no_entry: Error: {e}")
-			except ZeroDivisionError:
-				await ctx.embed_reply(":no_entry: Error: Division by zero")
-			except (concurrent.futures.TimeoutError, multiprocessing.context.TimeoutError):
-				await ctx.embed_reply(":no_entry: Execution exceeded time limit")
+		try:
+			result = await self.calculation_pool.run(10.0, evaluate, equation)
+			await ctx.embed_reply(f"{equation} = {result}")
+		except discord.HTTPException:
+			# TODO: use textwrap/paginate
+			await ctx.embed_reply(":no_entry: Output too long")
+		except SyntaxError:
+			await ctx.embed_reply(":no_entry: Syntax error")
+		except TypeError as e:
+			await ctx.embed_reply(f":no_entry: Error: {e}")
+		except ZeroDivisionError:
+			await ctx.embed_reply(":no_entry: Error: Division by zero")
+		except asyncio.TimeoutError:
+			await ctx.embed_reply(":no_entry: Execution exceeded time limit")
+		except MemoryError:
+			await ctx.embed_reply(":no_entry: Execution exceeded memory limit")
+		except WorkerError as e:
+			await ctx.embed_reply(f":no_entry: Error: {e}")
 	
 	@commands.command()
 	async def exp(self, ctx, value: float):
@@ -115,10 +161,15 @@ class Math(commands.Cog):
 		Differentiate an equation
 		with respect to x (dx)
 		'''
-		x = sympy.symbols('x')
 		try:
-			await ctx.embed_reply(f"`{sympy.diff(equation.strip('`'), x)}`",
+			await ctx.embed_reply(f"`{await self.compute_symbolic(differentiate_equation, equation)}`",
                                     title = f"Derivative of {equation}")
+		except asyncio.TimeoutError:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Computation exceeded time limit")
+		except MemoryError:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Computation exceeded memory limit")
+		except WorkerError as e:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Error: {e}")
 		except Exception as e:
 			await ctx.embed_reply(ctx.bot.PY_CODE_BLOCK.format(f"{type(e).__name__}: {e}"),
                                     title = "Error")
@@ -129,10 +180,15 @@ class Math(commands.Cog):
 		Integrate an equation
 		with respect to x (dx)
 		'''
-		x = sympy.symbols('x')
 		try:
-			await ctx.embed_reply(f"`{sympy.integrate(equation.strip('`'), x)}`",
+			await ctx.embed_reply(f"`{await self.compute_symbolic(integrate_equation, equation)}`",
                                     title = f"Integral of {equation}")
+		except asyncio.TimeoutError:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Computation exceeded time limit")
+		except MemoryError:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Computation exceeded memory limit")
+		except WorkerError as e:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Error: {e}")
 		except Exception as e:
 			await ctx.embed_reply(ctx.bot.PY_CODE_BLOCK.format(f"{type(e).__name__}: {e}"),
                                     title = "Error")
@@ -143,10 +199,15 @@ class Math(commands.Cog):
 		Definite integral of an equation
 		with respect to x (dx)
 		'''
-		x = sympy.symbols('x')
 		try:
-			await ctx.embed_reply(f"`{sympy.integrate(equation.strip('`'), (x, lower_limit, upper_limit))}`",
+			await ctx.embed_reply(f"`{await self.compute_symbolic(integrate_equation, equation, lower_limit, upper_limit)}`",
                                     title = f"Definite Integral of {equation} from {lower_limit} to {upper_limit}")
+		except asyncio.TimeoutError:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Computation exceeded time limit")
+		except MemoryError:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Computation exceeded memory limit")
+		except WorkerError as e:
+			await ctx.embed_reply(f"{ctx.bot.error_emoji} Error: {e}")
 		except Exception as e:
 			await ctx.embed_reply(ctx.bot.PY_CODE_BLOCK.format(f"{type(e).__name__}: {e}"),
                                     title = "Error")
@@ -122,25 +122,9 @@ class Meta(commands.Cog):
 		if not prefixes:
 			prefixes = ['!']
 		if ctx.channel.type is discord.ChannelType.private:
-			await ctx.bot.db.execute(
-				"""
-				INSERT INTO direct_messages.prefixes (channel_id, prefixes)
-				VALUES ($1, $2)
-				ON CONFLICT (channel_id) DO
-				UPDATE SET prefixes = $2
-				""", 
-				ctx.channel.id, prefixes
-			)
+			await ctx.bot.set_direct_message_prefixes(ctx.channel.id, prefixes)
 		else:
-			await ctx.bot.db.execute(
-				"""
-				INSERT INTO guilds.prefixes (guild_id, prefixes)
-				VALUES ($1, $2)
-				ON CONFLICT (guild_id) DO
-				UPDATE SET prefixes = $2
-				""", 
-				ctx.guild.id, prefixes
-			)
+			await ctx.bot.set_guild_prefixes(ctx.guild.id, prefixes)
 		await ctx.embed_reply("Prefix(es) set: " + ' '.join(f'`"{prefix}"`' for prefix in prefixes))
 	
 	@commands.group(aliases = ["shard"], invoke_without_command = True, case_insensitive = True)
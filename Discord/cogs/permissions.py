@@ -74,6 +74,7 @@ class Permissions(commands.Cog):
 			""", 
 			ctx.guild.id, self.bot.all_commands[permission].name, setting
 		)
+		ctx.bot.invalidate_guild_permissions(ctx.guild.id)
 		await ctx.embed_reply(f"{permission} set to {setting} for everyone", 
 								title = "Permission Updated")
 	
@@ -93,6 +94,7 @@ class Permissions(commands.Cog):
 			""", 
 			ctx.guild.id, role.id, self.bot.all_commands[permission].name, setting
 		)
+		ctx.bot.invalidate_guild_permissions(ctx.guild.id)
 		await ctx.embed_reply(f"{permission} set to {setting} for the role, {role.mention}", 
 								title = "Permission Updated")
 	
@@ -112,6 +114,7 @@ class Permissions(commands.Cog):
 			""", 
 			ctx.guild.id, user.id, self.bot.all_commands[permission].name, setting
 		)
+		ctx.bot.invalidate_guild_permissions(ctx.guild.id)
 		await ctx.embed_reply(f"{permission} set to {setting} for {user.mention}", 
 								title = "Permission Updated")
 	
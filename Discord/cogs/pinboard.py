@@ -2,10 +2,18 @@
 import discord
 from discord.ext import commands
 
+import asyncio
+import collections
+import logging
+import re
+import sys
+import traceback
 from typing import Optional
 
 from utilities import checks
 
+errors_logger = logging.getLogger("errors")
+
 def setup(bot):
 	bot.add_cog(Pinboard(bot))
 
@@ -14,6 +22,16 @@ class Pinboard(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
 		self.default_threshold = 3
+		# Channels fetched from concurrently while backfilling, as rate limits are per channel
+		self.backfill_concurrency = 4
+		# Pins sent between backfill progress writes
+		self.backfill_batch_size = 10
+		# Pinboard settings, by guild ID, or None for guilds without a pinboard
+		self.pinboards = {}
+		# Pending pinboard message updates, by pinned message ID
+		# Reactions within update_delay seconds are combined into one update
+		self.pinboard_updates = {}
+		self.update_delay = 2
 		self.pin_emotes = ("\N{PUSHPIN}", "\N{ROUND PUSHPIN}", 
 							"\N{WHITE MEDIUM STAR}", "\N{GLOWING STAR}", "\N{SHOOTING STAR}")
 		self.bot.loop.create_task(self.initialize_database(), name = "Initialize database")
@@ -50,6 +68,20 @@ class Pinboard(commands.Cog):
 			)
 			"""
 		)
+		await self.bot.db.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS pinboard.backfills (
+				guild_id			BIGINT PRIMARY KEY, 
+				last_message_id		BIGINT
+			)
+			"""
+		)
+		await self.bot.db.execute(
+			"""
+			ALTER TABLE pinboard.backfills
+			ADD COLUMN IF NOT EXISTS last_pinboard_message_id BIGINT
+			"""
+		)
 	
 	@commands.group(aliases = ["starboard"], invoke_without_command = True, case_insensitive = True)
 	@commands.is_owner()
@@ -68,6 +100,7 @@ class Pinboard(commands.Cog):
 		'''
 		Backfill pins into current pinboard channel
 		This can take a while depending on how many missing pinned messages there are
+		An interrupted backfill resumes where it stopped
 		'''
 		record = await ctx.bot.db.fetchrow(
 			"""
@@ -77,33 +110,83 @@ class Pinboard(commands.Cog):
 			""", 
 			ctx.guild.id
 		)
+		if not record or not record["channel_id"]:
+			return await ctx.embed_reply(":no_entry: Error: Pinboard channel not set")
 		pinboard_channel_id = record["channel_id"]
 		threshold = record["threshold"] or self.default_threshold
 		private_channels_setting = record["private_channels"]
-		if not pinboard_channel_id:
-			return await ctx.embed_reply(":no_entry: Error: Pinboard channel not set")
 		response = await ctx.embed_reply("Backfilling...")
 		pinboard_channel = self.bot.get_channel(pinboard_channel_id)
-		async with ctx.bot.database_connection_pool.acquire() as connection:
-			async with connection.transaction():
-				# Postgres requires non-scrollable cursors to be created
-				# and used in a transaction.
-				async for record in connection.cursor("SELECT * FROM pinboard.pins WHERE guild_id = $1 ORDER BY message_id", 
-														ctx.guild.id):
-					try:
-						await pinboard_channel.fetch_message(record["pinboard_message_id"])
-					except (discord.NotFound, discord.HTTPException):
-						pin_count = await self.bot.db.fetchval("SELECT COUNT(*) FROM pinboard.pinners WHERE message_id = $1",
-																record["message_id"])
-						if pin_count < threshold:
-							continue
-						pinned_message_channel = self.bot.get_channel(record["channel_id"])
-						if not private_channels_setting and pinned_message_channel.overwrites_for(ctx.guild.default_role).read_messages == False:
-							continue
-						pinned_message = await pinned_message_channel.fetch_message(record["message_id"])
-						pinboard_message = await self.send_pinboard_message(pinboard_channel, pinned_message, pin_count)
-						await self.bot.db.execute("UPDATE pinboard.pins SET pinboard_message_id = $1 WHERE message_id = $2",
-													pinboard_message.id, record["message_id"])
+		checkpoint = await ctx.bot.db.fetchrow(
+			"""
+			SELECT last_message_id, last_pinboard_message_id
+			FROM pinboard.backfills
+			WHERE guild_id = $1
+			""", 
+			ctx.guild.id
+		)
+		last_message_id = checkpoint and checkpoint["last_message_id"]
+		# Find existing pinboard messages, by their pinned message links, paging through the pinboard channel
+		# A resumed backfill only pages through pinboard messages after those already scanned
+		last_scanned_id = checkpoint and checkpoint["last_pinboard_message_id"]
+		pinboard_message_ids = {}
+		scanned_through = last_scanned_id
+		after = last_scanned_id and discord.Object(last_scanned_id)
+		async for message in pinboard_channel.history(limit = None, after = after):
+			scanned_through = max(message.id, scanned_through or 0)
+			if message.author == ctx.bot.user and message.embeds and message.embeds[0].fields:
+				if match := re.search(r"/(\d+)\)$", message.embeds[0].fields[0].value):
+					pinboard_message_ids.setdefault(int(match.group(1)), message.id)
+		# Pins at threshold, with pin counts aggregated in one query
+		records = await ctx.bot.db.fetch(
+			"""
+			SELECT pins.message_id, pins.channel_id, pins.pinboard_message_id, COUNT(*) AS pin_count
+			FROM pinboard.pins
+			INNER JOIN pinboard.pinners
+			ON pinboard.pins.message_id = pinboard.pinners.message_id
+			WHERE pins.guild_id = $1 AND pins.message_id > $2
+			GROUP BY pins.message_id
+			HAVING COUNT(*) >= $3
+			ORDER BY pins.message_id
+			""", 
+			ctx.guild.id, last_message_id or 0, threshold
+		)
+		updates = {}
+		missing = collections.defaultdict(list)
+		for record in records:
+			if pinboard_message_id := pinboard_message_ids.get(record["message_id"]):
+				if pinboard_message_id != record["pinboard_message_id"]:
+					updates[record["message_id"]] = pinboard_message_id
+				continue
+			if last_scanned_id and record["pinboard_message_id"] and record["pinboard_message_id"] <= last_scanned_id:
+				# Pinboard message was found when previously scanned
+				continue
+			pinned_message_channel = ctx.guild.get_channel(record["channel_id"])
+			if not pinned_message_channel:
+				continue
+			if not private_channels_setting and pinned_message_channel.overwrites_for(ctx.guild.default_role).read_messages == False:
+				continue
+			missing[pinned_message_channel].append(record)
+			if record["pinboard_message_id"]:
+				# Clear recorded pinboard message that wasn't found, so a resumed backfill doesn't skip it
+				updates[record["message_id"]] = None
+		# Fetch missing pinned messages
+		semaphore = asyncio.Semaphore(self.backfill_concurrency)
+		pinned_messages = {}
+		for messages in await asyncio.gather(*(self.fetch_messages(channel, [record["message_id"] for record in channel_records], semaphore) 
+												for channel, channel_records in missing.items())):
+			pinned_messages.update(messages)
+		# Send in order, as sending to the pinboard channel is a single rate limit bucket
+		missing = sorted((record for channel_records in missing.values() for record in channel_records), 
+							key = lambda record: record["message_id"])
+		for index, record in enumerate(missing, start = 1):
+			if pinned_message := pinned_messages.get(record["message_id"]):
+				pinboard_message = await self.send_pinboard_message(pinboard_channel, pinned_message, record["pin_count"])
+				updates[record["message_id"]] = pinboard_message.id
+			if index % self.backfill_batch_size == 0:
+				await self.write_backfill_progress(ctx.guild.id, updates, record["message_id"], scanned_through)
+				updates = {}
+		await self.write_backfill_progress(ctx.guild.id, updates, None, None)
 		if ctx.channel.id == pinboard_channel_id:
 			await ctx.bot.attempt_delete_message(response)
 		else:
@@ -111,6 +194,66 @@ class Pinboard(commands.Cog):
 			embed.description = "Backfill complete"
 			await response.edit(embed = embed)
 	
+	async def fetch_messages(self, channel, message_ids, semaphore):
+		'''
+		Fetch messages from channel by paging through history, falling back to fetching individually
+		History is only paged through for up to as many requests as fetching individually would take, 
+		so this takes at most twice as many requests, and usually far fewer
+		Messages that couldn't be fetched due to an HTTP error for the channel are skipped
+		'''
+		remaining = set(message_ids)
+		messages = {}
+		async with semaphore:
+			try:
+				async for message in channel.history(limit = 100 * len(message_ids), 
+														after = discord.Object(min(message_ids) - 1), 
+														before = discord.Object(max(message_ids) + 1), 
+														oldest_first = True):
+					if message.id in remaining:
+						remaining.remove(message.id)
+						messages[message.id] = message
+						if not remaining:
+							break
+				for message_id in sorted(remaining):
+					try:
+						messages[message_id] = await channel.fetch_message(message_id)
+					except discord.NotFound:
+						pass
+			except discord.HTTPException:
+				# Skip the rest of this channel, without affecting the other channels
+				pass
+		return messages
+	
+	async def write_backfill_progress(self, guild_id, updates, checkpoint, last_pinboard_message_id):
+		'''
+		Write pinboard message IDs and backfill checkpoint, or clear checkpoint if None
+		last_pinboard_message_id: Last pinboard message scanned for existing pinboard messages
+		'''
+		async with self.bot.db.acquire() as connection:
+			async with connection.transaction():
+				if updates:
+					await connection.execute(
+						"""
+						UPDATE pinboard.pins
+						SET pinboard_message_id = updates.pinboard_message_id
+						FROM UNNEST($1::BIGINT[], $2::BIGINT[]) AS updates (message_id, pinboard_message_id)
+						WHERE pins.message_id = updates.message_id
+						""", 
+						list(updates.keys()), list(updates.values())
+					)
+				if checkpoint:
+					await connection.execute(
+						"""
+						INSERT INTO pinboard.backfills (guild_id, last_message_id, last_pinboard_message_id)
+						VALUES ($1, $2, $3)
+						ON CONFLICT (guild_id) DO
+						UPDATE SET last_message_id = $2, last_pinboard_message_id = $3
+						""", 
+						guild_id, checkpoint, last_pinboard_message_id
+					)
+				else:
+					await connection.execute("DELETE FROM pinboard.backfills WHERE guild_id = $1", guild_id)
+	
 	# TODO: pinboard off option
 	@pinboard.command()
 	@commands.check_any(checks.is_permitted(), checks.is_guild_owner())
@@ -124,6 +267,7 @@ class Pinboard(commands.Cog):
 				channel = ctx.channel
 			await ctx.bot.db.execute("INSERT INTO pinboard.pinboards (guild_id, channel_id) VALUES ($1, $2)",
 										ctx.guild.id, channel.id)
+			self.pinboards.pop(ctx.guild.id, None)
 			await ctx.embed_reply(f":thumbsup::skin-tone-2: Pinboard channel set to {channel.mention}")
 		elif not channel:
 			pinboard_channel = ctx.guild.get_channel(channel_id)
@@ -131,6 +275,7 @@ class Pinboard(commands.Cog):
 		else:
 			await ctx.bot.db.execute("UPDATE pinboard.pinboards SET channel_id = $1 WHERE guild_id = $2",
 										channel.id, ctx.guild.id)
+			self.pinboards.pop(ctx.guild.id, None)
 			await ctx.embed_reply(f":thumbsup::skin-tone-2: Changed pinboard channel to {channel.mention}")
 	
 	@pinboard.command(aliases = ["starrers", "who", "pinner", "starrer"])
@@ -195,6 +340,7 @@ class Pinboard(commands.Cog):
 				""", 
 				setting, ctx.guild.id
 			)
+			self.pinboards.pop(ctx.guild.id, None)
 			await ctx.embed_reply(f":thumbsup::skin-tone-2: Changed pinboard private channels setting to {setting}")
 	
 	@pinboard.command()
@@ -208,6 +354,7 @@ class Pinboard(commands.Cog):
 		if threshold_number:
 			await ctx.bot.db.execute("UPDATE pinboard.pinboards SET threshold = $1 WHERE guild_id = $2",
 										threshold_number, ctx.guild.id)
+			self.pinboards.pop(ctx.guild.id, None)
 			await ctx.embed_reply(f":thumbsup::skin-tone-2: Changed pinboard threshold to {threshold_number}")
 		else:
 			threshold_number = await ctx.bot.db.fetchval("SELECT threshold FROM pinboard.pinboards WHERE guild_id = $1", 
@@ -217,6 +364,18 @@ class Pinboard(commands.Cog):
 			else:
 				await ctx.embed_reply(f"The current pinboard threshold is the default of 3")
 	
+	async def get_pinboard(self, guild_id):
+		if guild_id not in self.pinboards:
+			self.pinboards[guild_id] = await self.bot.db.fetchrow(
+				"""
+				SELECT channel_id, threshold, private_channels
+				FROM pinboard.pinboards
+				WHERE guild_id = $1
+				""", 
+				guild_id
+			)
+		return self.pinboards[guild_id]
+	
 	@commands.Cog.listener()
 	async def on_raw_reaction_add(self, payload):
 		if str(payload.emoji) not in self.pin_emotes:
@@ -225,79 +384,99 @@ class Pinboard(commands.Cog):
 		if not payload.guild_id:
 			# Reaction is not in a guild
 			return
-		record = await self.bot.db.fetchrow(
-			"""
-			SELECT channel_id, threshold, private_channels
-			FROM pinboard.pinboards
-			WHERE guild_id = $1
-			""", 
-			payload.guild_id
-		)
-		if not record:
+		if not (pinboard := await self.get_pinboard(payload.guild_id)):
 			# Guild doesn't have a pinboard
 			return
-		pinboard_channel_id = record["channel_id"]
-		threshold = record["threshold"] or self.default_threshold
-		private_channels_setting = record["private_channels"]
-		if payload.channel_id == pinboard_channel_id and (
-			record := await self.bot.db.fetchrow(
-				"""
-				SELECT message_id, channel_id
-				FROM pinboard.pins WHERE pinboard_message_id = $1
-				""", 
-				(pinboard_message_id := payload.message_id)
-			)
-		):
-			# Message being reacted to is on the pinboard
-			message_id = record["message_id"]
-			channel_id = record["channel_id"]
-		else:
-			message_id = payload.message_id
-			channel_id = payload.channel_id
-			pinboard_message_id = await self.bot.db.fetchval(
-				"""
+		pinboard_channel_id = pinboard["channel_id"]
+		threshold = pinboard["threshold"] or self.default_threshold
+		# Resolve reactions to messages on the pinboard to the pinned message, 
+		# add pin, and add user as pinner, in one statement
+		# A row is only returned if the user hadn't already pinned the message
+		record = await self.bot.db.fetchrow(
+			"""
+			WITH pinboard_pin AS (
+				SELECT message_id, channel_id, pinboard_message_id
+				FROM pinboard.pins
+				WHERE $4::BOOL AND pinboard_message_id = $1::BIGINT
+			), pin AS (
 				INSERT INTO pinboard.pins (message_id, guild_id, channel_id)
-				VALUES ($1, $2, $3)
-				ON CONFLICT (message_id) DO UPDATE SET guild_id = $2
-				RETURNING pinboard_message_id
-				""", 
-				message_id, payload.guild_id, payload.channel_id
+				SELECT $1::BIGINT, $2::BIGINT, $3::BIGINT
+				WHERE NOT EXISTS (SELECT FROM pinboard_pin)
+				ON CONFLICT (message_id) DO UPDATE SET guild_id = $2::BIGINT
+				RETURNING message_id, channel_id, pinboard_message_id
+			), target AS (
+				SELECT * FROM pinboard_pin
+				UNION ALL
+				SELECT * FROM pin
+			), pinner AS (
+				INSERT INTO pinboard.pinners (message_id, pinner_id)
+				SELECT message_id, $5::BIGINT FROM target
+				ON CONFLICT DO NOTHING
+				RETURNING message_id
 			)
-		# Add user as pinner
-		inserted = await self.bot.db.fetchrow(
-			"""
-			INSERT INTO pinboard.pinners (message_id, pinner_id)
-			VALUES ($1, $2)
-			ON CONFLICT DO NOTHING
-			RETURNING *
+			SELECT target.message_id, target.channel_id, target.pinboard_message_id
+			FROM target
+			INNER JOIN pinner
+			ON target.message_id = pinner.message_id
 			""", 
-			message_id, payload.user_id
+			payload.message_id, payload.guild_id, payload.channel_id, 
+			payload.channel_id == pinboard_channel_id, payload.user_id
 		)
-		if not inserted:
+		if not record:
 			# User has already pinned this message
 			return
-		pin_count = await self.bot.db.fetchval("SELECT COUNT(*) FROM pinboard.pinners WHERE message_id = $1",
-												message_id)
+		# Counted after the pinner is committed, as a count in the same statement's snapshot
+		# would miss concurrent pinners, so at least the last of a burst of reactions sees them all
+		pin_count = await self.bot.db.fetchval("SELECT COUNT(*) FROM pinboard.pinners WHERE message_id = $1", 
+												record["message_id"])
 		if pin_count < threshold:
 			# Pin count has not reached threshold yet
 			return
-		pinboard_channel = self.bot.get_channel(pinboard_channel_id)
-		pinned_message_channel = self.bot.get_channel(channel_id)
-		if not private_channels_setting and pinned_message_channel.overwrites_for(payload.member.guild.default_role).read_messages is False:
+		pinned_message_channel = self.bot.get_channel(record["channel_id"])
+		if not pinboard["private_channels"] and pinned_message_channel.overwrites_for(payload.member.guild.default_role).read_messages is False:
 			# Set to ignore private channels and message is in private channel
 			return
-		pinned_message = await pinned_message_channel.fetch_message(message_id)
-		if pinboard_message_id:
-			# Pinboard message already exists
-			pinboard_message = await pinboard_channel.fetch_message(pinboard_message_id)
-			embed = pinboard_message.embeds[0]
-			embed.clear_fields()
-			embed.add_field(name = f"**{pin_count}** \N{PUSHPIN}", value = f"[Message Link]({pinned_message.jump_url})")
-			await pinboard_message.edit(embed = embed)
-		else:
-			pinboard_message = await self.send_pinboard_message(pinboard_channel, pinned_message, pin_count)
-			await self.bot.db.execute("UPDATE pinboard.pins SET pinboard_message_id = $1 WHERE message_id = $2",
-										pinboard_message.id, message_id)
+		if update := self.pinboard_updates.get(record["message_id"]):
+			# Combine with pending update
+			update["pin_count"] = max(update["pin_count"], pin_count)
+			update["pinboard_message_id"] = update["pinboard_message_id"] or record["pinboard_message_id"]
+			return
+		self.pinboard_updates[record["message_id"]] = {
+			"pinboard_channel_id": pinboard_channel_id, "channel_id": record["channel_id"], 
+			"pinboard_message_id": record["pinboard_message_id"], "pin_count": pin_count
+		}
+		self.bot.loop.create_task(self.update_pinboard_message(record["message_id"]), name = "Update pinboard message")
+	
+	async def update_pinboard_message(self, message_id):
+		'''Send or edit pinboard message, after waiting to combine reactions'''
+		update = self.pinboard_updates[message_id]
+		try:
+			while True:
+				await asyncio.sleep(self.update_delay)
+				pin_count = update["pin_count"]
+				pinboard_channel = self.bot.get_channel(update["pinboard_channel_id"])
+				pinned_message = await self.bot.get_channel(update["channel_id"]).fetch_message(message_id)
+				if update["pinboard_message_id"]:
+					# Pinboard message already exists
+					pinboard_message = await pinboard_channel.fetch_message(update["pinboard_message_id"])
+					embed = pinboard_message.embeds[0]
+					embed.clear_fields()
+					embed.add_field(name = f"**{pin_count}** \N{PUSHPIN}", value = f"[Message Link]({pinned_message.jump_url})")
+					await pinboard_message.edit(embed = embed)
+				else:
+					pinboard_message = await self.send_pinboard_message(pinboard_channel, pinned_message, pin_count)
+					update["pinboard_message_id"] = pinboard_message.id
+					await self.bot.db.execute("UPDATE pinboard.pins SET pinboard_message_id = $1 WHERE message_id = $2",
+												pinboard_message.id, message_id)
+				if update["pin_count"] == pin_count:
+					# No more reactions since
+					break
+		except Exception as e:
+			print("Exception in pinboard message update", file = sys.stderr)
+			traceback.print_exception(type(e), e, e.__traceback__, file = sys.stderr)
+			errors_logger.error("Uncaught pinboard message update exception\n", exc_info = (type(e), e, e.__traceback__))
+		finally:
+			del self.pinboard_updates[message_id]
 	
 	async def send_pinboard_message(self, pinboard_channel, pinned_message, pin_count):
 		# TODO: custom emote
@@ -4,6 +4,8 @@ from discord.ext import commands, menus, tasks
 
 import asyncio
 import datetime
+import heapq
+import traceback
 from typing import Optional
 
 from parsedatetime import Calendar, VERSION_CONTEXT_STYLE
@@ -14,6 +16,37 @@ from utilities.menu import Menu
 def setup(bot):
 	bot.add_cog(Reminders(bot))
 
+def reminder_guild_id(bot, record):
+	'''Guild ID, '@me' for DMs, or None if unknown'''
+	if record["guild_id"]:
+		return record["guild_id"]
+	if record["direct_message"]:
+		return "@me"
+	# Older reminders that couldn't be backfilled
+	channel = bot.get_channel(record["channel_id"])
+	if isinstance(channel, discord.abc.PrivateChannel):
+		return "@me"
+	if channel:
+		return channel.guild.id
+
+def reminder_jump_url(bot, record):
+	# Built from stored IDs and cached channels, to avoid fetching the message
+	if guild_id := reminder_guild_id(bot, record):
+		return f"https://discord.com/channels/{guild_id}/{record['channel_id']}/{record['message_id']}"
+
+def format_reminder(bot, record):
+	guild_id = reminder_guild_id(bot, record)
+	if jump_url := reminder_jump_url(bot, record):
+		value = f"[{record['reminder'] or 'Reminder'}]({jump_url})"
+	else:
+		value = record["reminder"] or "Reminder"
+	if guild_id == "@me":
+		value += "\nIn DMs"
+	elif guild_id:
+		value += f"\nIn <#{record['channel_id']}>"
+	value += f"\nAt {record['remind_time'].isoformat(timespec = 'seconds').replace('+00:00', 'Z')}"
+	return value
+
 class Reminders(commands.Cog):
 	
 	def __init__(self, bot):
@@ -29,9 +62,11 @@ class Reminders(commands.Cog):
 		
 		self.menus = []
 		
-		self.current_timer = None
-		self.new_reminder = asyncio.Event()
-		self.restarting_timer = False
+		# Pending reminders, by ID, and heap of (remind_time, ID)
+		# Cancelled reminders are removed from the heap lazily
+		self.reminders = {}
+		self.reminders_heap = []
+		self.reminders_changed = asyncio.Event()
 		self.timer.start().set_name("Reminders")
 	
 	def cog_unload(self):
@@ -58,6 +93,18 @@ class Reminders(commands.Cog):
 			)
 			"""
 		)
+		await self.bot.db.execute(
+			"""
+			ALTER TABLE reminders.reminders
+			ADD COLUMN IF NOT EXISTS guild_id BIGINT
+			"""
+		)
+		await self.bot.db.execute(
+			"""
+			ALTER TABLE reminders.reminders
+			ADD COLUMN IF NOT EXISTS direct_message BOOL
+			"""
+		)
 	
 	async def cog_check(self, ctx):
 		return await checks.not_forbidden().predicate(ctx)
@@ -108,20 +155,16 @@ class Reminders(commands.Cog):
 											timestamp = parsed_datetime)
 		# Insert into database
 		created_time = ctx.message.created_at.replace(tzinfo = datetime.timezone.utc)
-		await self.bot.db.execute(
+		record = await self.bot.db.fetchrow(
 			"""
-			INSERT INTO reminders.reminders (user_id, channel_id, message_id, created_time, remind_time, reminder)
-			VALUES ($1, $2, $3, $4, $5, $6)
+			INSERT INTO reminders.reminders (user_id, guild_id, direct_message, channel_id, message_id, created_time, remind_time, reminder)
+			VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+			RETURNING *
 			""", 
-			ctx.author.id, ctx.channel.id, response.id, created_time, parsed_datetime, reminder
+			ctx.author.id, ctx.guild and ctx.guild.id, ctx.guild is None, ctx.channel.id, response.id, 
+			created_time, parsed_datetime, reminder
 		)
-		# Update timer
-		if self.current_timer and parsed_datetime < self.current_timer["remind_time"]:
-			self.restarting_timer = True
-			self.timer.restart()
-			self.timer.get_task().set_name("Reminders")
-		else:
-			self.new_reminder.set()
+		self.schedule_reminder(record)
 	
 	@reminder_command.command(aliases = ["delete", "remove"])
 	async def cancel(self, ctx, reminder_id: int):
@@ -137,10 +180,7 @@ class Reminders(commands.Cog):
 		)
 		if not cancelled:
 			return await ctx.embed_reply(f"{ctx.bot.error_emoji} Error: Unable to find and cancel reminder")
-		if self.current_timer and self.current_timer["id"] == reminder_id:
-			self.restarting_timer = True
-			self.timer.restart()
-			self.timer.get_task().set_name("Reminders")
+		self.reminders.pop(reminder_id, None)
 		await ctx.embed_reply(fields = (("Cancelled Reminder", cancelled["reminder"] or ctx.bot.ZWS),), 
 								footer_text = f"Set for {cancelled['remind_time'].isoformat(timespec = 'seconds').replace('+00:00', 'Z')}", 
 								timestamp = cancelled["remind_time"])
@@ -153,7 +193,7 @@ class Reminders(commands.Cog):
 		'''
 		records = await ctx.bot.db.fetch(
 			"""
-			SELECT id, channel_id, message_id, remind_time, reminder
+			SELECT id, guild_id, direct_message, channel_id, message_id, remind_time, reminder
 			FROM reminders.reminders
 			WHERE user_id = $1 AND reminded = FALSE AND cancelled = FALSE AND failed = FALSE
 			ORDER BY remind_time
@@ -161,19 +201,7 @@ class Reminders(commands.Cog):
 			""", 
 			ctx.author.id, min(count, 10), offset
 		)
-		fields = []
-		for record in records:
-			value = record["reminder"] or "Reminder"
-			if channel := ctx.bot.get_channel(record["channel_id"]):
-				try:
-					message = await channel.fetch_message(record["message_id"])
-					value = f"[{value}]({message.jump_url})"
-				except discord.NotFound:
-					pass
-				value += f"\nIn {getattr(channel, 'mention', 'DMs')}"
-			# TODO: Attempt to fetch channel?
-			value += f"\nAt {record['remind_time'].isoformat(timespec = 'seconds').replace('+00:00', 'Z')}"
-			fields.append((f"ID: {record['id']}", value))
+		fields = [(f"ID: {record['id']}", format_reminder(ctx.bot, record)) for record in records]
 		await ctx.embed_reply(title = "Reminders", fields = fields)
 	
 	@commands.command(name = "menu", aliases = ['m', "menus", 'r', "reaction", "reactions"])
@@ -184,7 +212,7 @@ class Reminders(commands.Cog):
 		'''
 		records = await ctx.bot.db.fetch(
 			"""
-			SELECT id, channel_id, message_id, remind_time, reminder
+			SELECT id, guild_id, direct_message, channel_id, message_id, remind_time, reminder
 			FROM reminders.reminders
 			WHERE user_id = $1 AND reminded = FALSE AND cancelled = FALSE AND failed = FALSE
 			ORDER BY remind_time
@@ -198,33 +226,66 @@ class Reminders(commands.Cog):
 	
 	# TODO: clear subcommand
 	
+	def schedule_reminder(self, record):
+		self.reminders[record["id"]] = record
+		heapq.heappush(self.reminders_heap, (record["remind_time"], record["id"]))
+		# Wake timer, in case this is the next reminder due
+		self.reminders_changed.set()
+	
 	# R/PT0S
 	@tasks.loop()
 	async def timer(self):
-		record = await self.bot.db.fetchrow(
-			"""
-			SELECT * FROM reminders.reminders
-			WHERE reminded = FALSE AND cancelled = FALSE AND failed = FALSE
-			ORDER BY remind_time
-			LIMIT 1
-			"""
-		)
-		if not record:
-			self.new_reminder.clear()
-			return await self.new_reminder.wait()
-		self.current_timer = record
-		await discord.utils.sleep_until(record["remind_time"])
+		# Discard cancelled reminders
+		while self.reminders_heap and self.reminders_heap[0][1] not in self.reminders:
+			heapq.heappop(self.reminders_heap)
+		self.reminders_changed.clear()
+		if not self.reminders_heap:
+			return await self.reminders_changed.wait()
+		delay = (self.reminders_heap[0][0] - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+		if delay > 0:
+			try:
+				# Reschedule if reminders are added or cancelled while waiting
+				return await asyncio.wait_for(self.reminders_changed.wait(), timeout = delay)
+			except asyncio.TimeoutError:
+				pass
+		# Fire all reminders due as a batch
+		now = datetime.datetime.now(datetime.timezone.utc)
+		records = []
+		while self.reminders_heap and self.reminders_heap[0][0] <= now:
+			_, reminder_id = heapq.heappop(self.reminders_heap)
+			if record := self.reminders.pop(reminder_id, None):
+				records.append(record)
+		results = await asyncio.gather(*(self.send_reminder(record) for record in records), 
+										return_exceptions = True)
+		reminded = []
+		failed = []
+		for record, result in zip(records, results):
+			if isinstance(result, Exception):
+				traceback.print_exception(type(result), result, result.__traceback__)
+			elif result:
+				reminded.append(record["id"])
+			else:
+				failed.append(record["id"])
+		async with self.bot.db.acquire() as connection:
+			async with connection.transaction():
+				if reminded:
+					await connection.execute(
+						"UPDATE reminders.reminders SET reminded = TRUE WHERE id = ANY($1::INT[])", reminded
+					)
+				if failed:
+					await connection.execute(
+						"UPDATE reminders.reminders SET failed = TRUE WHERE id = ANY($1::INT[])", failed
+					)
+	
+	async def send_reminder(self, record):
+		'''Send reminder, returning whether it was sent'''
 		if not (channel := self.bot.get_channel(record["channel_id"])):
 			# TODO: Attempt to fetch channel?
-			return await self.bot.db.execute("UPDATE reminders.reminders SET failed = TRUE WHERE id = $1", record["id"])
+			return False
 		user = self.bot.get_user(record["user_id"]) or await self.bot.fetch_user(record["user_id"])
 		# TODO: Handle user not found?
 		embed = discord.Embed(color = self.bot.bot_color)
-		try:
-			message = await channel.fetch_message(record["message_id"])
-			embed.description = f"[{record['reminder'] or 'Reminder'}]({message.jump_url})"
-		except discord.NotFound:
-			embed.description = record["reminder"] or "Reminder"
+		embed.description = f"[{record['reminder'] or 'Reminder'}]({reminder_jump_url(self.bot, record)})"
 		embed.set_footer(text = "Reminder set")
 		embed.timestamp = record["created_time"]
 		try:
@@ -232,21 +293,49 @@ class Reminders(commands.Cog):
 		except discord.Forbidden:
 			# TODO: Attempt to send without embed
 			# TODO: Fall back to DM
-			await self.bot.db.execute("UPDATE reminders.reminders SET failed = TRUE WHERE id = $1", record["id"])
-		else:
-			await self.bot.db.execute("UPDATE reminders.reminders SET reminded = TRUE WHERE id = $1", record["id"])
+			return False
+		return True
 	
 	@timer.before_loop
 	async def before_timer(self):
 		await self.initialize_database()
+		# Load pending reminders in bulk
+		records = await self.bot.db.fetch(
+			"""
+			SELECT * FROM reminders.reminders
+			WHERE reminded = FALSE AND cancelled = FALSE AND failed = FALSE
+			"""
+		)
+		for record in records:
+			self.reminders[record["id"]] = record
+			self.reminders_heap.append((record["remind_time"], record["id"]))
+		heapq.heapify(self.reminders_heap)
 		await self.bot.wait_until_ready()
+		# Store guild IDs and whether in DMs for reminders set before they were stored, using the channel cache
+		backfill = [(record["id"], getattr(channel, "guild", None) and channel.guild.id, 
+						isinstance(channel, discord.abc.PrivateChannel)) 
+					for record in records 
+					if record["guild_id"] is None and record["direct_message"] is None and 
+					(channel := self.bot.get_channel(record["channel_id"]))]
+		if backfill:
+			reminder_ids, guild_ids, direct_messages = map(list, zip(*backfill))
+			await self.bot.db.execute(
+				"""
+				UPDATE reminders.reminders
+				SET guild_id = backfill.guild_id, direct_message = backfill.direct_message
+				FROM UNNEST($1::INT[], $2::BIGINT[], $3::BOOL[]) AS backfill (id, guild_id, direct_message)
+				WHERE reminders.id = backfill.id
+				""", 
+				reminder_ids, guild_ids, direct_messages
+			)
+			for reminder_id, guild_id, direct_message in backfill:
+				if reminder_id in self.reminders:
+					self.reminders[reminder_id] = {**self.reminders[reminder_id], 
+													"guild_id": guild_id, "direct_message": direct_message}
 	
 	@timer.after_loop
 	async def after_timer(self):
-		if self.restarting_timer:
-			self.restarting_timer = False
-		else:
-			self.bot.print("Reminders task cancelled")
+		self.bot.print("Reminders task cancelled")
 
 class RemindersMenu(Menu, menus.MenuPages):
 	
@@ -269,17 +358,7 @@ class RemindersSource(menus.ListPageSource):
 		if self.per_page == 1:
 			records = [records]
 		for record in records:
-			value = record["reminder"] or "Reminder"
-			if channel := menu.bot.get_channel(record["channel_id"]):
-				try:
-					message = await channel.fetch_message(record["message_id"])
-					value = f"[{value}]({message.jump_url})"
-				except discord.NotFound:
-					pass
-				value += f"\nIn {getattr(channel, 'mention', 'DMs')}"
-			# TODO: Attempt to fetch channel?
-			value += f"\nAt {record['remind_time'].isoformat(timespec = 'seconds').replace('+00:00', 'Z')}"
-			embed.add_field(name = f"ID: {record['id']}", value = value)
+			embed.add_field(name = f"ID: {record['id']}", value = format_reminder(menu.bot, record))
 		offset = menu.current_page * self.per_page
 		start = offset + 1
 		end = min(offset + self.per_page, len(self.entries))
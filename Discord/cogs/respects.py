@@ -2,6 +2,8 @@
 import discord
 from discord.ext import commands
 
+import asyncio
+import collections
 import io
 import math
 
@@ -11,6 +13,7 @@ import numpy
 ## import scipy
 
 from utilities import checks
+from utilities.database import BufferedCounter
 
 def setup(bot):
 	bot.add_cog(Respects(bot))
@@ -19,8 +22,19 @@ class Respects(commands.Cog):
 	
 	def __init__(self, bot):
 		self.bot = bot
+		# Running totals, including buffered increments, by ("total", None), ("guild", guild_id), or ("user", user_id)
+		self.totals = collections.OrderedDict()
+		self.totals_max_size = 10000
+		self.counter = BufferedCounter(self.write_respects, name = "respects")
+		self.counter.start(self.bot.loop)
 		self.bot.loop.create_task(self.initialize_database(), name = "Initialize database")
 	
+	def cog_unload(self):
+		task = self.bot.loop.create_task(self.counter.close(), name = "Write buffered respects")
+		# Awaited by Bot.shutdown_tasks before closing the database connection
+		self.bot.unload_writes.add(task)
+		task.add_done_callback(self.bot.unload_writes.discard)
+	
 	async def initialize_database(self):
 		await self.bot.connect_to_database()
 		await self.bot.db.execute("CREATE SCHEMA IF NOT EXISTS respects")
@@ -56,6 +70,79 @@ class Respects(commands.Cog):
 			"""
 		)
 	
+	async def get_total(self, key):
+		if key in self.totals:
+			self.totals.move_to_end(key)
+			return self.totals[key]
+		# Wait for the previous instance of the cog to write its buffered respects, if reloaded
+		if self.bot.unload_writes:
+			await asyncio.wait(set(self.bot.unload_writes))
+		stat, stat_id = key
+		# Retry if buffered increments were being written during the read, 
+		# as they may or may not be included, so they're counted exactly once
+		while True:
+			if (write_sequence := self.counter.write_sequence) % 2:
+				# Wait for the write in progress
+				async with self.counter.flush_lock:
+					continue
+			if stat == "total":
+				total = await self.bot.db.fetchval("SELECT value FROM respects.stats WHERE stat = 'total'")
+			elif stat == "guild":
+				total = await self.bot.db.fetchval("SELECT respects FROM respects.guilds WHERE guild_id = $1", 
+													stat_id)
+			else:
+				total = await self.bot.db.fetchval("SELECT respects FROM respects.users WHERE user_id = $1", 
+													stat_id)
+			if self.counter.write_sequence == write_sequence:
+				break
+		total = (total or 0) + self.counter.counts[key]
+		# Another invocation may have loaded and incremented it meanwhile
+		total = self.totals.setdefault(key, total)
+		self.totals.move_to_end(key)
+		# Evicted totals are reloaded with their buffered increments
+		while len(self.totals) > self.totals_max_size:
+			self.totals.popitem(last = False)
+		return total
+	
+	async def increment(self, key):
+		await self.get_total(key)
+		self.totals[key] += 1
+		self.counter.increment(key)
+		return self.totals[key]
+	
+	async def write_respects(self, counts):
+		total = counts[("total", None)]
+		guilds = {guild_id: count for (stat, guild_id), count in counts.items() if stat == "guild"}
+		users = {user_id: count for (stat, user_id), count in counts.items() if stat == "user"}
+		async with self.bot.db.acquire() as connection:
+			async with connection.transaction():
+				await connection.execute(
+					"""
+					UPDATE respects.stats
+					SET value = value + $1
+					WHERE stat = 'total'
+					""", 
+					total
+				)
+				await connection.execute(
+					"""
+					INSERT INTO respects.guilds (guild_id, respects)
+					SELECT * FROM UNNEST($1::BIGINT[], $2::BIGINT[])
+					ON CONFLICT (guild_id) DO
+					UPDATE SET respects = guilds.respects + EXCLUDED.respects
+					""", 
+					list(guilds.keys()), list(guilds.values())
+				)
+				await connection.execute(
+					"""
+					INSERT INTO respects.users (user_id, respects)
+					SELECT * FROM UNNEST($1::BIGINT[], $2::BIGINT[])
+					ON CONFLICT (user_id) DO
+					UPDATE SET respects = users.respects + EXCLUDED.respects
+					""", 
+					list(users.keys()), list(users.values())
+				)
+	
 	async def cog_check(self, ctx):
 		return await checks.not_forbidden().predicate(ctx)
 	
@@ -74,12 +161,10 @@ class Respects(commands.Cog):
 		Record of respects paid by each user began on 2016-12-20
 		Record of respects paid by each server began on 2018-09-04
 		'''
-		user_respects = await ctx.bot.db.fetchval("SELECT respects FROM respects.users WHERE user_id = $1", 
-													ctx.author.id) or 0
+		user_respects = await self.get_total(("user", ctx.author.id))
 		if ctx.guild:
-			guild_respects = await ctx.bot.db.fetchval("SELECT respects FROM respects.guilds WHERE guild_id = $1", 
-														ctx.guild.id) or 0
-		total_respects = await ctx.bot.db.fetchval("SELECT value FROM respects.stats WHERE stat = 'total'")
+			guild_respects = await self.get_total(("guild", ctx.guild.id))
+		total_respects = await self.get_total(("total", None))
 		response = f"You have paid {user_respects:,} respects\n"
 		if ctx.guild:
 			response += f"This server has paid {guild_respects:,} respects\n"
@@ -92,35 +177,11 @@ class Respects(commands.Cog):
 		Pay Respects
 		Can also be triggered with 'f' or 'F'
 		'''
-		total_respects = await ctx.bot.db.fetchval(
-			"""
-			UPDATE respects.stats
-			SET value = value + 1
-			WHERE stat = 'total'
-			RETURNING value
-			"""
-		)
+		# Increments are written in batches, so bursts of respects don't each need writes
+		total_respects = await self.increment(("total", None))
 		if ctx.guild:
-			guild_respects = await ctx.bot.db.fetchval(
-				"""
-				INSERT INTO respects.guilds (guild_id, respects)
-				VALUES ($1, 1)
-				ON CONFLICT (guild_id) DO
-				UPDATE SET respects = guilds.respects + 1
-				RETURNING respects
-				""", 
-				ctx.guild.id
-			)
-		user_respects = await ctx.bot.db.fetchval(
-			"""
-			INSERT INTO respects.users (user_id, respects)
-			VALUES ($1, 1)
-			ON CONFLICT (user_id) DO
-			UPDATE SET respects = users.respects + 1
-			RETURNING respects
-			""", 
-			ctx.author.id
-		)
+			guild_respects = await self.increment(("guild", ctx.guild.id))
+		user_respects = await self.increment(("user", ctx.author.id))
 		suffix = ctx.bot.inflect_engine.ordinal(user_respects)[len(str(user_respects)):]
 		response = f"{ctx.author.mention} has paid their respects for the {user_respects:,}{suffix} time\n"
 		if ctx.guild:
@@ -131,6 +192,7 @@ class Respects(commands.Cog):
 	@respects.command(aliases = ["statistics"])
 	async def stats(self, ctx):
 		'''Statistics'''
+		await self.counter.flush()
 		total_respects = await ctx.bot.db.fetchval("SELECT value FROM respects.stats WHERE stat = 'total'")
 		respects_paid = []
 		async with ctx.bot.database_connection_pool.acquire() as connection:
@@ -178,6 +240,7 @@ class Respects(commands.Cog):
 		'''Top respects paid'''
 		if number > 10:
 			number = 10
+		await self.counter.flush()
 		fields = []
 		async with ctx.bot.database_connection_pool.acquire() as connection:
 			async with connection.transaction():
@@ -29,6 +29,39 @@ errors_logger = logging.getLogger("errors")
 def setup(bot):
 	bot.add_cog(RSS(bot))
 
+class FeedSchedule:
+	
+	'''
+	Schedule for checking a feed
+	The interval adapts to how often the feed publishes new entries,
+	and failed checks back off exponentially
+	'''
+	
+	MINIMUM_INTERVAL = datetime.timedelta(minutes = 1)
+	MAXIMUM_INTERVAL = datetime.timedelta(hours = 1)
+	MAXIMUM_BACKOFF = datetime.timedelta(hours = 6)
+	
+	def __init__(self, next_check):
+		self.next_check = next_check
+		self.interval = self.MINIMUM_INTERVAL
+		self.failures = 0
+	
+	def checked(self, *, new_entries, ttl = None):
+		self.failures = 0
+		if new_entries:
+			self.interval = max(self.interval / 2, self.MINIMUM_INTERVAL)
+		else:
+			self.interval = min(self.interval * 1.5, self.MAXIMUM_INTERVAL)
+		interval = self.interval
+		if ttl:
+			interval = max(interval, datetime.timedelta(minutes = ttl))
+		self.next_check = datetime.datetime.now(datetime.timezone.utc) + interval
+	
+	def failed(self):
+		self.failures += 1
+		backoff = min(self.MINIMUM_INTERVAL * 2 ** min(self.failures, 10), self.MAXIMUM_BACKOFF)
+		self.next_check = datetime.datetime.now(datetime.timezone.utc) + backoff
+
 class RSS(commands.Cog):
 	
 	def __init__(self, bot):
@@ -43,10 +76,25 @@ class RSS(commands.Cog):
 				self.tzinfos[timezone_abbreviation] = dateutil.tz.gettz(matching_timezones[0])
 		
 		self.new_feed = asyncio.Event()
+		self.feed_session = None  # Initialized before checking feeds
+		self.feed_schedules = {}
+		self.feed_checks = {}
+		self.known_entry_ids = {}
 		self.check_feeds.start().set_name("RSS")
 	
 	def cog_unload(self):
 		self.check_feeds.cancel()
+		for task in self.feed_checks.values():
+			task.cancel()
+		if self.feed_session:
+			self.bot.loop.create_task(self.feed_session.close(), name = "Close RSS feed session")
+	
+	async def initialize_feed_session(self):
+		# Limit concurrent connections, in total and per host, for checking feeds concurrently
+		self.feed_session = aiohttp.ClientSession(
+			connector = aiohttp.TCPConnector(limit = 50, limit_per_host = 2), 
+			timeout = aiohttp.ClientTimeout(total = None, sock_connect = 10, sock_read = 30)
+		)
 	
 	async def inititalize_database(self):
 		await self.bot.connect_to_database()
@@ -58,10 +106,19 @@ class RSS(commands.Cog):
 				feed			TEXT, 
 				last_checked	TIMESTAMPTZ, 
 				ttl				INT, 
+				etag			TEXT, 
+				last_modified	TEXT, 
 				PRIMARY KEY		(channel_id, feed)
 			)
 			"""
 		)
+		await self.bot.db.execute(
+			"""
+			ALTER TABLE rss.feeds
+			ADD COLUMN IF NOT EXISTS etag TEXT, 
+			ADD COLUMN IF NOT EXISTS last_modified TEXT
+			"""
+		)
 		await self.bot.db.execute(
 			"""
 			CREATE TABLE IF NOT EXISTS rss.entries (
@@ -114,15 +171,14 @@ class RSS(commands.Cog):
 		ttl = None
 		if "ttl" in feed_info.feed:
 			ttl = int(feed_info.feed.ttl)
-		for entry in feed_info.entries:
-			await ctx.bot.db.execute(
-				"""
-				INSERT INTO rss.entries (entry, feed)
-				VALUES ($1, $2)
-				ON CONFLICT (entry, feed) DO NOTHING
-				""", 
-				entry.id, url
-			)
+		await ctx.bot.db.execute(
+			"""
+			INSERT INTO rss.entries (entry, feed)
+			SELECT entry, $2 FROM UNNEST($1::TEXT[]) AS entry
+			ON CONFLICT (entry, feed) DO NOTHING
+			""", 
+			[entry.id for entry in feed_info.entries if "id" in entry], url
+		)
 		await ctx.bot.db.execute(
 			"""
 			INSERT INTO rss.feeds (channel_id, feed, last_checked, ttl)
@@ -157,12 +213,12 @@ class RSS(commands.Cog):
 		await ctx.embed_reply('\n'.join(record["feed"] for record in records), 
 								title = "RSS feeds being followed in this channel")
 	
-	# R/PT60S
-	@tasks.loop(seconds = 60)
+	# R/PT15S
+	@tasks.loop(seconds = 15)
 	async def check_feeds(self):
 		records = await self.bot.db.fetch(
 			"""
-			SELECT DISTINCT ON (feed) feed, last_checked, ttl
+			SELECT DISTINCT ON (feed) feed, last_checked, ttl, etag, last_modified
 			FROM rss.feeds
 			ORDER BY feed, last_checked
 			"""
@@ -170,156 +226,209 @@ class RSS(commands.Cog):
 		if not records:
 			self.new_feed.clear()
 			await self.new_feed.wait()
+		now = datetime.datetime.now(datetime.timezone.utc)
+		feeds = set()
 		for record in records:
 			feed = record["feed"]
-			if record["ttl"] and datetime.datetime.now(datetime.timezone.utc) < record["last_checked"] + datetime.timedelta(minutes = record["ttl"]):
-				continue
-			try:
-				async with self.bot.aiohttp_session.get(feed) as resp:
-					feed_text = await resp.text()
-				feed_info = await self.bot.loop.run_in_executor(None, functools.partial(feedparser.parse, io.BytesIO(feed_text.encode("UTF-8")), response_headers = {"Content-Location": feed}))
-				# Still necessary to run in executor?
-				ttl = None
-				if "ttl" in feed_info.feed:
-					ttl = int(feed_info.feed.ttl)
-				await self.bot.db.execute(
-					"""
-					UPDATE rss.feeds
-					SET last_checked = NOW(), 
-						ttl = $1
-					WHERE feed = $2
-					""", 
-					ttl, feed
-				)
-				for entry in feed_info.entries:
-					if "id" not in entry:
-						continue
-					inserted = await self.bot.db.fetchrow(
+			feeds.add(feed)
+			if not (schedule := self.feed_schedules.get(feed)):
+				next_check = now
+				if record["ttl"] and record["last_checked"]:
+					next_check = record["last_checked"] + datetime.timedelta(minutes = record["ttl"])
+				schedule = self.feed_schedules[feed] = FeedSchedule(next_check)
+			# Check each feed in its own task, so failing or slow feeds don't delay others
+			if feed not in self.feed_checks and now >= schedule.next_check:
+				task = self.bot.loop.create_task(self.check_feed(record), name = f"Check RSS feed: {feed}")
+				task.add_done_callback(lambda _, feed = feed: self.feed_checks.pop(feed, None))
+				self.feed_checks[feed] = task
+		# Remove schedules for feeds no longer being followed
+		for feed in self.feed_schedules.keys() - feeds:
+			del self.feed_schedules[feed]
+			self.known_entry_ids.pop(feed, None)
+	
+	async def check_feed(self, feed_record):
+		feed = feed_record["feed"]
+		schedule = self.feed_schedules[feed]
+		try:
+			# Conditional GET, with validators from last check
+			headers = {}
+			if feed_record["etag"]:
+				headers["If-None-Match"] = feed_record["etag"]
+			if feed_record["last_modified"]:
+				headers["If-Modified-Since"] = feed_record["last_modified"]
+			async with self.feed_session.get(feed, headers = headers) as resp:
+				if resp.status == 304:  # Not Modified
+					await self.bot.db.execute(
+						"""
+						UPDATE rss.feeds
+						SET last_checked = NOW()
+						WHERE feed = $1
+						""", 
+						feed
+					)
+					schedule.checked(new_entries = False, ttl = feed_record["ttl"])
+					return
+				feed_text = await resp.text()
+				etag = resp.headers.get("ETag")
+				last_modified = resp.headers.get("Last-Modified")
+			feed_info = await self.bot.loop.run_in_executor(None, functools.partial(feedparser.parse, io.BytesIO(feed_text.encode("UTF-8")), response_headers = {"Content-Location": feed}))
+			# Still necessary to run in executor?
+			ttl = None
+			if "ttl" in feed_info.feed:
+				ttl = int(feed_info.feed.ttl)
+			await self.bot.db.execute(
+				"""
+				UPDATE rss.feeds
+				SET last_checked = NOW(), 
+					ttl = $1, 
+					etag = $2, 
+					last_modified = $3
+				WHERE feed = $4
+				""", 
+				ttl, etag, last_modified, feed
+			)
+			entry_ids = [entry.id for entry in feed_info.entries if "id" in entry]
+			# Skip entries already seen in the last check of this feed without querying the database
+			known_entry_ids = self.known_entry_ids.get(feed, set())
+			if unknown_entry_ids := [entry_id for entry_id in entry_ids if entry_id not in known_entry_ids]:
+				new_entry_ids = set(
+					record["entry"] for record in await self.bot.db.fetch(
 						"""
 						INSERT INTO rss.entries (entry, feed)
-						VALUES ($1, $2)
+						SELECT entry, $2 FROM UNNEST($1::TEXT[]) AS entry
 						ON CONFLICT DO NOTHING
-						RETURNING *
+						RETURNING entry
 						""", 
-						entry.id, feed
+						unknown_entry_ids, feed
 					)
-					if not inserted:
-						continue
-					# Get timestamp
-					## if "published_parsed" in entry:
-					##  timestamp = datetime.datetime.fromtimestamp(time.mktime(entry.published_parsed))
-					### inaccurate
-					if "published" in entry and entry.published:
-						timestamp = dateutil.parser.parse(entry.published, tzinfos = self.tzinfos)
-					elif "updated" in entry:  # and entry.updated necessary?; check updated first?
-						timestamp = dateutil.parser.parse(entry.updated, tzinfos = self.tzinfos)
-					else:
-						timestamp = discord.Embed.Empty
-					# Get and set description, title, url + set timestamp
-					if not (description := entry.get("summary")) and "content" in entry:
-						description = entry["content"][0].get("value")
-					if description:
-						description = BeautifulSoup(description, "lxml").get_text(separator = '\n')
-						description = re.sub(r"\n\s*\n", '\n', description)
-						if len(description) > self.bot.EMBED_DESCRIPTION_CHARACTER_LIMIT:
-							space_index = description.rfind(' ', 0, self.bot.EDCL - 3)
-							# EDCL: Embed Description Character Limit
-							description = description[:space_index] + "..."
-					title = textwrap.shorten(entry.get("title"), width = self.bot.ETiCL, placeholder = "...")
-					# ETiCL: Embed Title Character Limit
-					embed = discord.Embed(title = html.unescape(title), 
-											url = entry.link, 
-											description = description, 
-											timestamp = timestamp, 
-											color = self.bot.rss_color)
-					# Get and set thumbnail url
-					thumbnail_url = (
-						(media_thumbnail := entry.get("media_thumbnail")) and media_thumbnail[0].get("url") or 
-						(
-							(media_content := entry.get("media_content")) and 
-							(media_image := discord.utils.find(lambda c: "image" in c.get("medium", ""), media_content)) and 
-							media_image.get("url")
-						) or 
-						(
-							(links := entry.get("links")) and 
-							(image_link := discord.utils.find(lambda l: "image" in l.get("type", ""), links)) and 
-							image_link.get("href")
-						 ) or 
-						(
-							(content := entry.get("content")) and (content_value := content[0].get("value")) and 
-							(content_img := getattr(BeautifulSoup(content_value, "lxml"), "img")) and 
-							content_img.get("src")
-						) or 
-						(
-							(media_content := entry.get("media_content")) and 
-							(media_content := discord.utils.find(lambda c: "url" in c, media_content)) and 
-							media_content["url"]
-						) or 
-						(
-							(description := entry.get("description")) and 
-							(description_img := getattr(BeautifulSoup(description, "lxml"), "img")) and 
-							description_img.get("src")
-						)
-					)
-					if thumbnail_url:
-						if not urllib.parse.urlparse(thumbnail_url).netloc:
-							thumbnail_url = feed_info.feed.link + thumbnail_url
-						embed.set_thumbnail(url = thumbnail_url)
-					# Get and set footer icon url
-					footer_icon_url = (
-						feed_info.feed.get("icon") or feed_info.feed.get("logo") or 
-						(feed_image := feed_info.feed.get("image")) and feed_image.get("href") or 
-						(parsed_image := BeautifulSoup(feed_text, "lxml").image) and next(iter(parsed_image.attrs.values()), None) or 
-						discord.Embed.Empty
+				)
+			else:
+				new_entry_ids = set()
+			self.known_entry_ids[feed] = set(entry_ids)
+			new_entries = bool(new_entry_ids)
+			if new_entries:
+				# Get footer icon url
+				footer_icon_url = (
+					feed_info.feed.get("icon") or feed_info.feed.get("logo") or 
+					(feed_image := feed_info.feed.get("image")) and feed_image.get("href") or 
+					(parsed_image := BeautifulSoup(feed_text, "lxml").image) and next(iter(parsed_image.attrs.values()), None) or 
+					discord.Embed.Empty
+				)
+				channel_records = await self.bot.db.fetch("SELECT channel_id FROM rss.feeds WHERE feed = $1", feed)
+			for entry in feed_info.entries:
+				if entry.get("id") not in new_entry_ids:
+					continue
+				# Handle duplicate entries in feed
+				new_entry_ids.remove(entry.id)
+				# Get timestamp
+				## if "published_parsed" in entry:
+				##  timestamp = datetime.datetime.fromtimestamp(time.mktime(entry.published_parsed))
+				### inaccurate
+				if "published" in entry and entry.published:
+					timestamp = dateutil.parser.parse(entry.published, tzinfos = self.tzinfos)
+				elif "updated" in entry:  # and entry.updated necessary?; check updated first?
+					timestamp = dateutil.parser.parse(entry.updated, tzinfos = self.tzinfos)
+				else:
+					timestamp = discord.Embed.Empty
+				# Get and set description, title, url + set timestamp
+				if not (description := entry.get("summary")) and "content" in entry:
+					description = entry["content"][0].get("value")
+				if description:
+					description = BeautifulSoup(description, "lxml").get_text(separator = '\n')
+					description = re.sub(r"\n\s*\n", '\n', description)
+					if len(description) > self.bot.EMBED_DESCRIPTION_CHARACTER_LIMIT:
+						space_index = description.rfind(' ', 0, self.bot.EDCL - 3)
+						# EDCL: Embed Description Character Limit
+						description = description[:space_index] + "..."
+				title = textwrap.shorten(entry.get("title"), width = self.bot.ETiCL, placeholder = "...")
+				# ETiCL: Embed Title Character Limit
+				embed = discord.Embed(title = html.unescape(title), 
+										url = entry.link, 
+										description = description, 
+										timestamp = timestamp, 
+										color = self.bot.rss_color)
+				# Get and set thumbnail url
+				thumbnail_url = (
+					(media_thumbnail := entry.get("media_thumbnail")) and media_thumbnail[0].get("url") or 
+					(
+						(media_content := entry.get("media_content")) and 
+						(media_image := discord.utils.find(lambda c: "image" in c.get("medium", ""), media_content)) and 
+						media_image.get("url")
+					) or 
+					(
+						(links := entry.get("links")) and 
+						(image_link := discord.utils.find(lambda l: "image" in l.get("type", ""), links)) and 
+						image_link.get("href")
+					 ) or 
+					(
+						(content := entry.get("content")) and (content_value := content[0].get("value")) and 
+						(content_img := getattr(BeautifulSoup(content_value, "lxml"), "img")) and 
+						content_img.get("src")
+					) or 
+					(
+						(media_content := entry.get("media_content")) and 
+						(media_content := discord.utils.find(lambda c: "url" in c, media_content)) and 
+						media_content["url"]
+					) or 
+					(
+						(description := entry.get("description")) and 
+						(description_img := getattr(BeautifulSoup(description, "lxml"), "img")) and 
+						description_img.get("src")
 					)
-					embed.set_footer(text = feed_info.feed.title, icon_url = footer_icon_url)
-					# Send embed(s)
-					channel_records = await self.bot.db.fetch("SELECT channel_id FROM rss.feeds WHERE feed = $1", feed)
-					for record in channel_records:
-						if text_channel := self.bot.get_channel(record["channel_id"]):
-							try:
-								await text_channel.send(embed = embed)
-							except discord.Forbidden:
-								pass
-							except discord.HTTPException as e:
-								if e.status == 400 and e.code == 50035:
-									if "In embed.url: Not a well formed URL." in e.text:
-										embed.url = discord.Embed.Empty
-									if "In embed.thumbnail.url: Not a well formed URL." in e.text:
-										embed.set_thumbnail(url = "")
-									if "In embed.footer.icon_url: Not a well formed URL." in e.text:
-										embed.set_footer(text = feed_info.feed.title)
-									await text_channel.send(embed = embed)
-								else:
-									raise
-						# TODO: Remove text channel data if now non-existent
-			except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, 
-					aiohttp.TooManyRedirects, asyncio.TimeoutError, 
-					UnicodeDecodeError) as e:
-				await self.bot.db.execute(
-					"""
-					INSERT INTO rss.errors (feed, type, message)
-					VALUES ($1, $2, $3)
-					""", 
-					feed, type(e).__name__, str(e)
 				)
-				# Print error?
-				await asyncio.sleep(10)
-				# TODO: Add variable for sleep time
-				# TODO: Remove persistently erroring feed or exponentially backoff?
-			except discord.DiscordServerError as e:
-				self.bot.print(f"RSS Task Discord Server Error: {e}")
-				await asyncio.sleep(60)
-			except Exception as e:
-				print("Exception in RSS Task", file = sys.stderr)
-				traceback.print_exception(type(e), e, e.__traceback__, file = sys.stderr)
-				errors_logger.error("Uncaught RSS Task exception\n", exc_info = (type(e), e, e.__traceback__))
-				print(f" (feed: {feed})")
-				await asyncio.sleep(60)
+				if thumbnail_url:
+					if not urllib.parse.urlparse(thumbnail_url).netloc:
+						thumbnail_url = feed_info.feed.link + thumbnail_url
+					embed.set_thumbnail(url = thumbnail_url)
+				# Set footer icon url
+				embed.set_footer(text = feed_info.feed.title, icon_url = footer_icon_url)
+				# Send embed(s)
+				for record in channel_records:
+					if text_channel := self.bot.get_channel(record["channel_id"]):
+						try:
+							await text_channel.send(embed = embed)
+						except discord.Forbidden:
+							pass
+						except discord.HTTPException as e:
+							if e.status == 400 and e.code == 50035:
+								if "In embed.url: Not a well formed URL." in e.text:
+									embed.url = discord.Embed.Empty
+								if "In embed.thumbnail.url: Not a well formed URL." in e.text:
+									embed.set_thumbnail(url = "")
+								if "In embed.footer.icon_url: Not a well formed URL." in e.text:
+									embed.set_footer(text = feed_info.feed.title)
+								await text_channel.send(embed = embed)
+							else:
+								raise
+					# TODO: Remove text channel data if now non-existent
+			schedule.checked(new_entries = new_entries, ttl = ttl)
+		except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, 
+				aiohttp.TooManyRedirects, asyncio.TimeoutError, 
+				UnicodeDecodeError) as e:
+			schedule.failed()
+			await self.bot.db.execute(
+				"""
+				INSERT INTO rss.errors (feed, type, message)
+				VALUES ($1, $2, $3)
+				""", 
+				feed, type(e).__name__, str(e)
+			)
+			# Print error?
+			# TODO: Remove persistently erroring feed?
+		except discord.DiscordServerError as e:
+			schedule.failed()
+			self.bot.print(f"RSS Task Discord Server Error: {e}")
+		except Exception as e:
+			schedule.failed()
+			print("Exception in RSS Task", file = sys.stderr)
+			traceback.print_exception(type(e), e, e.__traceback__, file = sys.stderr)
+			errors_logger.error("Uncaught RSS Task exception\n", exc_info = (type(e), e, e.__traceback__))
+			print(f" (feed: {feed})")
 	
 	@check_feeds.before_loop
 	async def before_check_feeds(self):
 		await self.inititalize_database()
+		await self.initialize_feed_session()
 		await self.bot.wait_until_ready()
 	
 	@check_feeds.after_loop
@@ -2,7 +2,8 @@
 import discord
 from discord.ext import commands
 
-import difflib
+import asyncio
+import collections
 import io
 import re
 import textwrap
@@ -17,16 +18,42 @@ import seaborn
 
 from utilities import checks
 from utilities.paginator import Paginator
+from utilities.workers import WorkerError, WorkerPool
 
 def setup(bot):
 	bot.add_cog(Tools(bot))
 
+def initialize_graph_worker():
+	'''Configure matplotlib and render a figure, so graph workers are warm'''
+	import matplotlib.figure
+	matplotlib.use("Agg")
+	render_graph(0, 1, 'x')
+
+def render_graph(lower_limit, upper_limit, equation):
+	'''Render graph of equation as PNG, in a worker process'''
+	x = numpy.linspace(lower_limit, upper_limit, 250)
+	y = numexpr.evaluate(equation)
+	figure = matplotlib.figure.Figure()
+	axes = figure.add_subplot()
+	axes.plot(x, y)
+	buffer = io.BytesIO()
+	figure.savefig(buffer, format = "PNG")
+	return buffer.getvalue()
+
 class Tools(commands.Cog):
 	
 	def __init__(self, bot):
 		self.bot = bot
+		self.graph_pool = WorkerPool(2, memory_limit = 2 * 2 ** 30, initializer = initialize_graph_worker)
+		self.graph_pool.start()
+		# Graph PNGs, by limits and normalized equation
+		self.graphs = collections.OrderedDict()
+		self.graphs_max_size = 256
 		self.bot.loop.create_task(self.initialize_database(), name = "Initialize database")
 	
+	def cog_unload(self):
+		self.graph_pool.close()
+	
 	async def initialize_database(self):
 		await self.bot.connect_to_database()
 		await self.bot.db.execute("CREATE SCHEMA IF NOT EXISTS tags")
@@ -51,6 +78,20 @@ class Tools(commands.Cog):
 			)
 			"""
 		)
+		# Trigram indexes for similarity and substring search
+		await self.bot.db.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+		await self.bot.db.execute(
+			"""
+			CREATE INDEX IF NOT EXISTS global_tag_trigram_index
+			ON tags.global USING GIN (tag gin_trgm_ops)
+			"""
+		)
+		await self.bot.db.execute(
+			"""
+			CREATE INDEX IF NOT EXISTS individual_tag_trigram_index
+			ON tags.individual USING GIN (tag gin_trgm_ops)
+			"""
+		)
 	
 	@commands.group(aliases = ["plot"], invoke_without_command = True, case_insensitive = True)
 	@checks.not_forbidden()
@@ -60,22 +101,25 @@ class Tools(commands.Cog):
 			equation = self.string_to_equation(equation)
 		except SyntaxError as e:
 			return await ctx.embed_reply(f":no_entry: Error: {e}")
-		x = numpy.linspace(lower_limit, upper_limit, 250)
-		try:
-			y = numexpr.evaluate(equation)
-		except Exception as e:
-			return await ctx.reply(ctx.bot.PY_CODE_BLOCK.format(f"{type(e).__name__}: {e}"))
-		figure = matplotlib.figure.Figure()
-		axes = figure.add_subplot()
-		try:
-			axes.plot(x, y)
-		except ValueError as e:
-			return await ctx.embed_reply(f":no_entry: Error: {e}")
-		buffer = io.BytesIO()
-		figure.savefig(buffer, format = "PNG")
-		buffer.seek(0)
+		key = (lower_limit, upper_limit, ' '.join(equation.split()))
+		if (graph := self.graphs.get(key)) is not None:
+			self.graphs.move_to_end(key)
+		else:
+			try:
+				graph = await self.graph_pool.run(30.0, render_graph, *key)
+			except asyncio.TimeoutError:
+				return await ctx.embed_reply(":no_entry: Rendering exceeded time limit")
+			except MemoryError:
+				return await ctx.embed_reply(":no_entry: Rendering exceeded memory limit")
+			except WorkerError as e:
+				return await ctx.embed_reply(f":no_entry: Error: {e}")
+			except Exception as e:
+				return await ctx.reply(ctx.bot.PY_CODE_BLOCK.format(f"{type(e).__name__}: {e}"))
+			self.graphs[key] = graph
+			if len(self.graphs) > self.graphs_max_size:
+				self.graphs.popitem(last = False)
 		await ctx.embed_reply(image_url = "attachment://graph.png", 
-								file = discord.File(buffer, filename = "graph.png"))
+								file = discord.File(io.BytesIO(graph), filename = "graph.png"))
 	
 	def string_to_equation(self, string):
 		replacements = {'^': "**"}
@@ -201,17 +245,7 @@ class Tools(commands.Cog):
 			)
 			# TODO: Optimize into single query
 			return
-		individual_records = await ctx.bot.db.fetch(
-			"""
-			SELECT tag FROM tags.individual
-			WHERE user_id = $1
-			""", 
-			ctx.author.id
-		)
-		global_records = await ctx.bot.db.fetch("SELECT tag FROM tags.global")
-		# TODO Optimize into single query?
-		tags = [record["tag"] for record in individual_records] + [record["tag"] for record in global_records]
-		close_matches = difflib.get_close_matches(tag, tags)
+		close_matches = await self.get_close_tag_matches(tag, ctx.author.id, include_global = True)
 		close_matches = "\nDid you mean:\n{}".format('\n'.join(close_matches)) if close_matches else ""
 		await ctx.embed_reply("Tag not found{}".format(close_matches))
 	
@@ -303,17 +337,19 @@ class Tools(commands.Cog):
 	async def tag_search(self, ctx, *, search: str):
 		'''Search your tags'''
 		if (await self.check_no_tags(ctx)): return
+		# Escape LIKE pattern characters
+		pattern = search.replace('\\', "\\\\").replace('%', "\\%").replace('_', "\\_")
 		records = await ctx.bot.db.fetch(
 			"""
 			SELECT tag FROM tags.individual
-			WHERE user_id = $1
+			WHERE user_id = $1 AND tag LIKE '%' || $2 || '%'
+			ORDER BY tag
 			""", 
-			ctx.author.id
+			ctx.author.id, pattern
 		)
-		tags = [record["tag"] for record in records]
-		if results := [tag for tag in tags if search in tag]:
+		if results := [record["tag"] for record in records]:
 			return await ctx.embed_reply(f"{len(results)} tags found: {', '.join(results)}")
-		close_matches = difflib.get_close_matches(search, tags)
+		close_matches = await self.get_close_tag_matches(search, ctx.author.id)
 		close_matches = "\nDid you mean:\n" + '\n'.join(close_matches) if close_matches else ""
 		await ctx.embed_reply(f"No tags found{close_matches}")
 	
@@ -448,19 +484,29 @@ class Tools(commands.Cog):
 			ctx.author.id, tag
 		)
 		if not exists:
-			records = await ctx.bot.db.fetch(
-				"""
-				SELECT tag FROM tags.individual
-				WHERE user_id = $1
-				""", 
-				ctx.author.id
-			)
-			tags = [record["tag"] for record in records]
-			close_matches = difflib.get_close_matches(tag, tags)
+			close_matches = await self.get_close_tag_matches(tag, ctx.author.id)
 			close_matches = "\nDid you mean:\n{}".format('\n'.join(close_matches)) if close_matches else ""
 			await ctx.embed_reply("You don't have that tag{}".format(close_matches))
 		return not exists
 	
+	async def get_close_tag_matches(self, tag, user_id, *, include_global = False):
+		'''Get the most similar tags, using the trigram indexes'''
+		records = await self.bot.db.fetch(
+			"""
+			SELECT tag FROM (
+				SELECT tag FROM tags.individual
+				WHERE user_id = $1 AND tag % $2
+				UNION
+				SELECT tag FROM tags.global
+				WHERE $3 AND tag % $2
+			) AS tags
+			ORDER BY similarity(tag, $2) DESC
+			LIMIT 3
+			""", 
+			user_id, tag, include_global
+		)
+		return [record["tag"] for record in records]
+	
 	@commands.command(hidden = True)
 	@checks.not_forbidden()
 	async def webmtogif(self, ctx):
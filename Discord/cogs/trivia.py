@@ -4,6 +4,7 @@ from discord.ext import commands
 
 import asyncio
 import datetime
+import functools
 import html
 import random
 import re
@@ -20,6 +21,211 @@ from utilities import checks
 def setup(bot):
 	bot.add_cog(Trivia(bot))
 
+def remove_article_prefix(string):
+	for article in ("a ", "an ", "the "):
+		if string.startswith(article):
+			return string[len(article):]
+	return string
+
+@functools.lru_cache(maxsize = 4096)
+def plural(inflect_engine, string):
+	# Cached, as guesses are often repeated
+	return inflect_engine.plural(string)
+
+def split_items(string):
+	# Get items in list
+	items = [item.strip() for item in string.split(',')]
+	items[-1:] = [item.strip() for item in items[-1].split("and") if item]
+	return [remove_article_prefix(item) for item in items]
+
+def suffixed_items(items):
+	# XX and YY ZZ -> XX ZZ and YY ZZ
+	last = items[-1].split()
+	if len(last) > 1:
+		suffix = last[-1]
+		return frozenset([f"{item} {suffix}" for item in items[:-1]] + [items[-1]])
+
+class AnswerMatcher:
+	
+	'''
+	Matcher for responses to a trivia answer
+	The answer is normalized once, into sets of accepted forms
+	so that checking each response only needs to normalize the response
+	'''
+	
+	# Grammar for words with optional parenthesized words
+	word = Word(printables, excludeChars = "()")
+	token = Forward()
+	token << ( word | Group(Suppress('(') + OneOrMore(token) + Suppress(')')) )
+	optional_parentheses_expression = ZeroOrMore(token)
+	del word, token
+	
+	response_translation = str.maketrans({'’': "'", '&': "and", '!': None, '.': None, '"': None})
+	abbreviations = [(re.compile(fr"(^|\W)({abbreviation})($|\W)"), fr"\1{word}\3") 
+						for abbreviation, word in (("dr", "doctor"), ("mt", "mount"), ("st", "saint"))]
+	
+	def __init__(self, answer, inflect_engine):
+		self.inflect_engine = inflect_engine
+		# Unescape HTML entities in answer and extract text between HTML tags
+		# Replace \' -> '
+		self.text = BeautifulSoup(html.unescape(answer), "html.parser").get_text().replace("\\'", "'")
+		answer = self.normalize(self.text.replace('&', "and").replace('!', "").replace('.', "").replace('"', ""))
+		
+		# Removal of/replacement of - with space (prior to removing article prefixes), with commas removed
+		self.full_hyphens_replaced = answer.replace(',', "").replace('-', ' ')
+		self.full_hyphens_removed = answer.replace(',', "").replace('-', "")
+		
+		answer = remove_article_prefix(answer)
+		self.answer = answer
+		
+		# Items in lists
+		answer_items = split_items(answer)
+		self.items = frozenset(answer_items)
+		self.items_hyphens_replaced = frozenset(item.replace('-', ' ') for item in answer_items)
+		self.items_hyphens_removed = frozenset(item.replace('-', "") for item in answer_items)
+		# XX and YY ZZ
+		self.suffixed_items = suffixed_items(answer_items) if answer_items else None
+		
+		# Plurality
+		self.plural = plural(self.inflect_engine, answer) if answer else None
+		
+		# Remove commas
+		answer = answer.replace(',', "")
+		# List separated by /
+		self.slash_items = frozenset(item.strip() for item in answer.split('/'))
+		# Removal of/replacement of - with space
+		self.hyphens_replaced = answer.replace('-', ' ')
+		self.hyphens_removed = answer.replace('-', "")
+		
+		# Exact responses accepted
+		self.accepted = set()
+		# Removal of parentheses
+		self.accepted.add(remove_article_prefix(answer.replace('(', "").replace(')', "")))
+		# XX or YY, XX/YY, XX and/or YY
+		self.accepted.update(answer.split(" or "))
+		self.accepted.update(answer.split('/'))
+		self.accepted.update(answer.split(" and/or "))
+		# XX/YY ZZ
+		answer_words = answer.split()
+		if answer_words:
+			answers = answer_words[0].split('/')
+			for answer_word in answer_words[1:]:
+				if '/' in answer_word:
+					answers = [f"{permutation} {word}" for permutation in answers for word in answer_word.split('/')]
+				else:
+					answers = [f"{permutation} {answer_word}" for permutation in answers]
+			self.accepted.update(answers)
+		# Optional parentheses
+		self.accepted.update(self.optional_parentheses_accepted(answer))
+		# XX YY (or ZZ accepted)
+		if matches := re.search(r"(.+?)\s?\((?:or )?(?:a |an |the )?(.+?)(?: accepted)?\)", answer):
+			self.accepted.add(f"{matches.group(1).rsplit(' ', 1)[0]} {matches.group(2)}")
+		
+		# Numbers to words conversion
+		self.number_words = self.numbers_to_words(answer)
+		# Abbreviations
+		self.abbreviations_expanded = [pattern.sub(replacement, answer) 
+										for pattern, replacement in self.abbreviations]
+	
+	@staticmethod
+	def normalize(string):
+		# Remove diacritics
+		string = "".join(character for character in unicodedata.normalize("NFD", string) 
+							if not unicodedata.combining(character))
+		# Remove extra whitespace
+		# Make lowercase
+		return ' '.join(string.split()).lower()
+	
+	def numbers_to_words(self, string):
+		words = string.split()
+		for index, word in enumerate(words):
+			if word[0].isdigit():
+				words[index] = self.inflect_engine.number_to_words(word)
+		return ' '.join(words)
+	
+	def optional_parentheses_accepted(self, answer):
+		parsed = self.optional_parentheses_expression.parseString(answer).asList()
+		def add_accepted(accepted, item, initial_length = 0):
+			if isinstance(item, list):
+				accepted = add_optional_accepted(accepted, item)
+			else:
+				for accepted_index, accepted_item in enumerate(accepted[initial_length:]):
+					accepted[initial_length + accepted_index] = f"{accepted_item} {item}".lstrip()
+			return accepted
+		def add_optional_accepted(accepted, optional):
+			initial_length = len(accepted)
+			if isinstance(optional[0], list):
+				accepted = add_optional_accepted(accepted, optional[0])
+			else:
+				for accepted_item in accepted.copy():
+					accepted.append(f"{accepted_item} {optional[0]}".lstrip())
+			for item in optional[1:]:
+				add_accepted(accepted, item, initial_length = initial_length)
+			return accepted
+		accepted = [""]
+		for item in parsed:
+			accepted = add_accepted(accepted, item)
+		for item in parsed:
+			if isinstance(item, list):
+				accepted.extend(add_optional_accepted([""], item)[1:])
+		for item in accepted:
+			if item.startswith("or "):
+				accepted.append(item[3:])
+				accepted.append(remove_article_prefix(item[3:]))
+			if item.endswith(" accepted"):
+				accepted.append(item[:-9])
+				accepted.append(remove_article_prefix(item[:-9]))
+		return accepted
+	
+	def matches(self, response):
+		response = self.normalize(response.translate(self.response_translation))
+		
+		# Check removal of/replacement of - with space (prior to removing article prefixes)
+		# Remove commas beforehand
+		response_copy = response.replace(',', "")
+		if (response_copy.replace('-', ' ') == self.full_hyphens_replaced or 
+			response_copy.replace('-', "") == self.full_hyphens_removed):
+			return True
+		
+		response = remove_article_prefix(response)
+		# Return False if empty response
+		if not response:
+			return False
+		response_items = split_items(response)
+		# Return False if only "and"
+		if not response_items:
+			return False
+		# Check equivalence, replacement of - with space, and removal of -
+		response_items_set = frozenset(response_items)
+		if (response_items_set == self.items or 
+			frozenset(item.replace('-', ' ') for item in response_items) == self.items_hyphens_replaced or 
+			frozenset(item.replace('-', "") for item in response_items) == self.items_hyphens_removed):
+			return True
+		# Check plurality
+		if response == self.plural:
+			return True
+		# Check XX and YY ZZ
+		if response_items_set == self.suffixed_items or suffixed_items(response_items) == self.items:
+			return True
+		
+		# Remove commas
+		response = response.replace(',', "")
+		# Check list separated by /, removal of/replacement of - with space, and exact matches
+		if (frozenset(item.strip() for item in response.split('/')) == self.slash_items or 
+			response.replace('-', ' ') == self.hyphens_replaced or 
+			response.replace('-', "") == self.hyphens_removed or 
+			response in self.accepted):
+			return True
+		# Check abbreviations
+		for (pattern, replacement), expanded in zip(self.abbreviations, self.abbreviations_expanded):
+			if pattern.sub(replacement, response) == expanded:
+				return True
+		# Check numbers to words conversion
+		if self.numbers_to_words(response) == self.number_words:
+			return True
+		# Check plurality of response last, as it's the most expensive
+		return plural(self.inflect_engine, response) == self.answer
+
 class Trivia(commands.Cog):
 	
 	def __init__(self, bot):
@@ -146,8 +352,9 @@ class Trivia(commands.Cog):
 			pass
 		correct_players = []
 		incorrect_players = []
+		answer = AnswerMatcher(data["answer"], ctx.bot.inflect_engine)
 		for player, response in self.active_trivia[ctx.guild.id]["responses"].items():
-			if self.check_answer(data["answer"], response):
+			if answer.matches(response):
 				correct_players.append(player)
 			else:
 				incorrect_players.append(player)
@@ -176,8 +383,7 @@ class Trivia(commands.Cog):
 				""", 
 				incorrect_player.id
 			)
-		answer = BeautifulSoup(html.unescape(data["answer"]), "html.parser").get_text().replace("\\'", "'")
-		await ctx.embed_reply(f"The answer was `{answer}`", 
+		await ctx.embed_reply(f"The answer was `{answer.text}`", 
 								footer_text = correct_players_output, 
 								author_name = None, in_response_to = False)
 		if bet and self.active_trivia[ctx.guild.id]["bets"]:
@@ -362,7 +568,7 @@ class Trivia(commands.Cog):
 				await ctx.embed_reply(f"{ctx.bot.error_emoji} That question has already been chosen")
 				continue
 			self.active_jeopardy[ctx.guild.id]["answerer"] = None
-			self.active_jeopardy[ctx.guild.id]["answer"] = clue["answer"]
+			self.active_jeopardy[ctx.guild.id]["answer"] = AnswerMatcher(clue["answer"], ctx.bot.inflect_engine)
 			self.active_jeopardy[ctx.guild.id]["question_countdown"] = self.wait_time
 			message = await ctx.embed_reply(clue["question"], title = board[category_id]["title"], author_name = None, 
 											footer_text = f"You have {self.wait_time} seconds left to answer | Air Date", 
@@ -377,9 +583,7 @@ class Trivia(commands.Cog):
 					break
 			embed.set_footer(text = "Time's up! | Air Date")
 			await message.edit(embed = embed)
-			answer = BeautifulSoup(html.unescape(self.active_jeopardy[ctx.guild.id]["answer"]), 
-									"html.parser").get_text().replace("\\'", "'")
-			response = f"The answer was `{answer}`\n"
+			response = f"The answer was `{self.active_jeopardy[ctx.guild.id]['answer'].text}`\n"
 			if answerer := self.active_jeopardy[ctx.guild.id]["answerer"]:
 				scores[answerer] = scores.get(answerer, 0) + int(value)
 				response += f"{answerer.mention} was right! They now have ${scores[answerer]}\n"
@@ -404,190 +608,9 @@ class Trivia(commands.Cog):
 		if message.channel.id != self.active_jeopardy[message.guild.id]["channel_id"]:
 			return
 		if (self.active_jeopardy[message.guild.id]["question_countdown"] and 
-			self.check_answer(self.active_jeopardy[message.guild.id]["answer"], message.content) and 
+			self.active_jeopardy[message.guild.id]["answer"].matches(message.content) and 
 			not self.active_jeopardy[message.guild.id]["answerer"]):
 				self.active_jeopardy[message.guild.id]["answerer"] = message.author
 	
 	# TODO: jeopardy stats
-	
-	def check_answer(self, answer, response):
-		# Unescape HTML entities in answer and extract text between HTML tags
-		answer = BeautifulSoup(html.unescape(answer), "html.parser").get_text()
-		# Replace in answer: \' -> '
-		# Replace in response: ’ -> '
-		# Replace: & -> and
-		answer = answer.replace("\\'", "'").replace('&', "and")
-		response = response.replace('’', "'").replace('&', "and")
-		# Remove exclamation marks, periods, and quotation marks
-		for character in '!."':
-			if character in answer:
-				answer = answer.replace(character, "")
-			if character in response:
-				response = response.replace(character, "")
-		# Remove diacritics
-		answer = "".join(character for character in unicodedata.normalize("NFD", answer) 
-							if not unicodedata.combining(character))
-		response = "".join(character for character in unicodedata.normalize("NFD", response) 
-							if not unicodedata.combining(character))
-		# Remove extra whitespace
-		# Make lowercase
-		answer = ' '.join(answer.split()).lower()
-		response = ' '.join(response.split()).lower()
-		
-		# Check removal of/replacement of - with space (prior to removing article prefixes)
-		# Remove commas beforehand
-		answer_copy = answer.replace(',', "")
-		response_copy = response.replace(',', "")
-		if answer_copy.replace('-', ' ') == response_copy.replace('-', ' '):
-			return True
-		if answer_copy.replace('-', "") == response_copy.replace('-', ""):
-			return True
-		
-		# Remove article prefixes
-		answer = self.remove_article_prefix(answer)
-		response = self.remove_article_prefix(response)
-		# Return False if empty response
-		if not response:
-			return False
-		
-		# Get items in lists
-		answer_items = [item.strip() for item in answer.split(',')]
-		answer_items[-1:] = [item.strip() for item in answer_items[-1].split("and") if item]
-		response_items = [item.strip() for item in response.split(',')]
-		response_items[-1:] = [item.strip() for item in response_items[-1].split("and") if item]
-		# Return False if only "and"
-		if not response_items:
-			return False
-		# Remove article prefixes
-		for index, item in enumerate(answer_items):
-			answer_items[index] = self.remove_article_prefix(item)
-		for index, item in enumerate(response_items):
-			response_items[index] = self.remove_article_prefix(item)
-		# Check equivalence
-		if set(answer_items) == set(response_items):
-			return True
-		# Check replacement of - with space
-		answer_items_copy = {item.replace('-', ' ') for item in answer_items}
-		response_items_copy = {item.replace('-', ' ') for item in response_items}
-		if answer_items_copy == response_items_copy:
-			return True
-		# Check removal of -
-		answer_items_copy = {item.replace('-', "") for item in answer_items}
-		response_items_copy = {item.replace('-', "") for item in response_items}
-		if answer_items_copy == response_items_copy:
-			return True
-		
-		# Check plurality
-		if response == self.bot.inflect_engine.plural(answer):
-			return True
-		if answer == self.bot.inflect_engine.plural(response):
-			return True
-		# Check XX and YY ZZ
-		last = answer_items[-1].split()
-		if len(last) > 1:
-			suffix = last[-1]
-			if set([f"{item} {suffix}" for item in answer_items[:-1]] + [answer_items[-1]]) == set(response_items):
-				return True
-		last = response_items[-1].split()
-		if len(last) > 1:
-			suffix = last[-1]
-			if set(answer_items) == set([f"{item} {suffix}" for item in response_items[:-1]] + [response_items[-1]]):
-				return True
-		# Remove commas
-		if ',' in answer:
-			answer = answer.replace(',', "")
-		if ',' in response:
-			response = response.replace(',', "")
-		# Check for list separated by /
-		if set(item.strip() for item in answer.split('/')) == set(item.strip() for item in response.split('/')):
-			return True
-		# Check removal of/replacement of - with space
-		if answer.replace('-', ' ') == response.replace('-', ' '):
-			return True
-		if answer.replace('-', "") == response.replace('-', ""):
-			return True
-		# Check removal of parentheses
-		if response == self.remove_article_prefix(answer.replace('(', "").replace(')', "")):
-			return True
-		# Check XX or YY
-		if response in answer.split(" or "):
-			return True
-		# Check XX/YY
-		if response in answer.split('/'):
-			return True
-		# Check XX and/or YY
-		if response in answer.split(" and/or "):
-			return True
-		# Check XX/YY ZZ
-		answer_words = answer.split()
-		answers = answer_words[0].split('/')
-		for answer_word in answer_words[1:]:
-			if '/' in answer_word:
-				answers = [f"{permutation} {word}" for permutation in answers for word in answer_word.split('/')]
-			else:
-				answers = [f"{permutation} {answer_word}" for permutation in answers]
-		if response in answers:
-			return True
-		# Check numbers to words conversion
-		response_words = response.split()
-		for words in (answer_words, response_words):
-			for index, word in enumerate(words):
-				if word[0].isdigit():
-					words[index] = self.bot.inflect_engine.number_to_words(word)
-		if ' '.join(answer_words) == ' '.join(response_words):
-			return True
-		# Handle optional parentheses
-		word = Word(printables, excludeChars = "()")
-		token = Forward()
-		token << ( word | Group(Suppress('(') + OneOrMore(token) + Suppress(')')) )
-		expression = ZeroOrMore(token)
-		parsed = expression.parseString(answer).asList()
-		def add_accepted(accepted, item, initial_length = 0):
-			if isinstance(item, list):
-				accepted = add_optional_accepted(accepted, item)
-			else:
-				for accepted_index, accepted_item in enumerate(accepted[initial_length:]):
-					accepted[initial_length + accepted_index] = f"{accepted_item} {item}".lstrip()
-			return accepted
-		def add_optional_accepted(accepted, optional):
-			initial_length = len(accepted)
-			if isinstance(optional[0], list):
-				accepted = add_optional_accepted(accepted, optional[0])
-			else:
-				for accepted_item in accepted.copy():
-					accepted.append(f"{accepted_item} {optional[0]}".lstrip())
-			for item in optional[1:]:
-				add_accepted(accepted, item, initial_length = initial_length)
-			return accepted
-		accepted = [""]
-		for item in parsed:
-			accepted = add_accepted(accepted, item)
-		for item in parsed:
-			if isinstance(item, list):
-				accepted.extend(add_optional_accepted([""], item)[1:])
-		for item in accepted:
-			if item.startswith("or "):
-				accepted.append(item[3:])
-				accepted.append(self.remove_article_prefix(item[3:]))
-			if item.endswith(" accepted"):
-				accepted.append(item[:-9])
-				accepted.append(self.remove_article_prefix(item[:-9]))
-		if response in accepted:
-			return True
-		# Check XX YY (or ZZ accepted)
-		matches = re.search(r"(.+?)\s?\((?:or )?(?:a |an |the )?(.+?)(?: accepted)?\)", answer)
-		if matches and response == f"{matches.group(1).rsplit(' ', 1)[0]} {matches.group(2)}":
-			return True
-		# Check abbreviations
-		for abbreviation, word in (("dr", "doctor"), ("mt", "mount"), ("st", "saint")):
-			if (re.sub(fr"(^|\W)({abbreviation})($|\W)", fr"\1{word}\3", answer) == 
-				re.sub(fr"(^|\W)({abbreviation})($|\W)", fr"\1{word}\3", response)):
-				return True
-		return False
-	
-	def remove_article_prefix(self, string):
-		for article in ("a ", "an ", "the "):
-			if string.startswith(article):
-				return string[len(article):]
-		return string
 
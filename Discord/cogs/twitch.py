@@ -6,10 +6,12 @@ import asyncio
 import datetime
 import logging
 import sys
+import time
 import traceback
 
 import aiohttp
 import dateutil.parser
+import more_itertools
 
 from utilities import checks
 
@@ -18,10 +20,33 @@ errors_logger = logging.getLogger("errors")
 def setup(bot):
 	bot.add_cog(Twitch(bot))
 
+class TokenBucket:
+	
+	'''Token bucket rate limiter'''
+	
+	def __init__(self, rate, capacity):
+		self.rate = rate  # tokens per second
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated_at = time.monotonic()
+		self.lock = asyncio.Lock()
+	
+	async def acquire(self):
+		async with self.lock:
+			while True:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+				self.updated_at = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				await asyncio.sleep((1 - self.tokens) / self.rate)
+
 class Twitch(commands.Cog):
 	
 	def __init__(self, bot):
 		self.bot = bot
+		self.rate_limiter = TokenBucket(rate = 1, capacity = 10)
 		self.check_streams.start().set_name("Twitch")
 	
 	def cog_unload(self):
@@ -317,48 +342,36 @@ class Twitch(commands.Cog):
 	# R/PT60S
 	@tasks.loop(seconds = 60)
 	async def check_streams(self):
-		headers = {"Accept": "application/vnd.twitchtv.v5+json"}  # Use Twitch API v5
 		try:
-			stream_ids = []
+			stream_ids = set()
+			# Request all games, keywords, and batches of channels concurrently, within rate limit
+			games = [record["game"] for record in await self.bot.db.fetch("SELECT DISTINCT game FROM twitch_notifications.games")]
+			keywords = [record["keyword"] for record in await self.bot.db.fetch("SELECT DISTINCT keyword FROM twitch_notifications.keywords")]
+			user_ids = [record["user_id"] for record in await self.bot.db.fetch("SELECT DISTINCT user_id FROM twitch_notifications.channels")]
+			# Channels are requested in batches of the maximum of 100 per request
+			user_id_batches = list(more_itertools.chunked(user_ids, 100))
+			results = await asyncio.gather(
+				*(self.fetch_streams("https://api.twitch.tv/kraken/streams", {"game": game}) 
+					for game in games), 
+				*(self.fetch_streams("https://api.twitch.tv/kraken/search/streams", {"query": keyword}) 
+					for keyword in keywords), 
+				*(self.fetch_streams("https://api.twitch.tv/kraken/streams", {"channel": ','.join(batch)}, paginate = True) 
+					for batch in user_id_batches)
+			)
+			games_streams = results[:len(games)]
+			keywords_streams = results[len(games):len(games) + len(keywords)]
+			channels_streams = results[len(games) + len(keywords):]
 			# Games
-			records = await self.bot.db.fetch("SELECT DISTINCT game FROM twitch_notifications.games")
-			url = "https://api.twitch.tv/kraken/streams"
-			for record in records:
-				game = record["game"]
-				params = {"game": game, "client_id": self.bot.TWITCH_CLIENT_ID, "limit": 100}
-				async with self.bot.aiohttp_session.get(url, params = params, headers = headers) as resp:
-					if resp.status in (421, 502, 503):
-						continue
-					games_data = await resp.json()
-				streams = games_data.get("streams", [])
-				stream_ids += [str(stream["_id"]) for stream in streams]
+			for game, streams in zip(games, games_streams):
+				stream_ids.update(str(stream["_id"]) for stream in streams)
 				await self.process_streams(streams, "games", match = game)
-				await asyncio.sleep(1)
 			# Keywords
-			records = await self.bot.db.fetch("SELECT DISTINCT keyword FROM twitch_notifications.keywords")
-			url = "https://api.twitch.tv/kraken/search/streams"
-			for record in records:
-				keyword = record["keyword"]
-				params = {"query": keyword, "client_id": self.bot.TWITCH_CLIENT_ID, "limit": 100}
-				async with self.bot.aiohttp_session.get(url, params = params, headers = headers) as resp:
-					keywords_data = await resp.json()
-				streams = keywords_data.get("streams", [])
-				stream_ids += [str(stream["_id"]) for stream in streams]
+			for keyword, streams in zip(keywords, keywords_streams):
+				stream_ids.update(str(stream["_id"]) for stream in streams)
 				await self.process_streams(streams, "keywords", match = keyword)
-				await asyncio.sleep(1)
 			# Streams
-			streams_data = {}
-			records = await self.bot.db.fetch("SELECT DISTINCT user_id FROM twitch_notifications.channels")
-			if records:
-				url = "https://api.twitch.tv/kraken/streams"
-				params = {"channel": ','.join(record["user_id"] for record in records), 
-							"client_id": self.bot.TWITCH_CLIENT_ID, "limit": 100}
-				async with self.bot.aiohttp_session.get(url, params = params, headers = headers) as resp:
-					if resp.status not in (502, 503, 504):
-						streams_data = await resp.json()
-					# TODO: Handle >100 streams
-				streams = streams_data.get("streams", [])
-				stream_ids += [str(stream["_id"]) for stream in streams]
+			for streams in channels_streams:
+				stream_ids.update(str(stream["_id"]) for stream in streams)
 				await self.process_streams(streams, "streams")
 			# Update streams notified
 			records = await self.bot.db.fetch(
@@ -415,6 +428,23 @@ class Twitch(commands.Cog):
 	async def after_check_streams(self):
 		self.bot.print("Twitch task cancelled")
 	
+	async def fetch_streams(self, url, params, *, paginate = False):
+		headers = {"Accept": "application/vnd.twitchtv.v5+json"}  # Use Twitch API v5
+		streams = []
+		offset = 0
+		while True:
+			await self.rate_limiter.acquire()
+			params = {**params, "client_id": self.bot.TWITCH_CLIENT_ID, "limit": 100, "offset": offset}
+			async with self.bot.aiohttp_session.get(url, params = params, headers = headers) as resp:
+				if resp.status in (421, 502, 503, 504):
+					return streams
+				streams_data = await resp.json()
+			page = streams_data.get("streams", [])
+			streams += page
+			offset += len(page)
+			if not paginate or not page or offset >= streams_data.get("_total", 0):
+				return streams
+	
 	async def process_streams(self, streams, type, match = None):
 		# TODO: use textwrap
 		for stream in streams:
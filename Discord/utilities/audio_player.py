@@ -26,6 +26,14 @@ class AudioPlayer:
 		# TODO: server specific default volume
 		self.skip_votes_required = 0
 		self.skip_votes = set()
+		# Download upcoming songs in advance
+		self.prefetch_count = 2
+		self.prefetch_disk_budget = 500 * 2 ** 20  # bytes
+		self.prefetch_semaphore = asyncio.Semaphore(1)
+		self.prefetches = {}
+		# Stream songs from their media URL, instead of downloading them before playing
+		self.stream_songs = False
+		self.cache_streamed_songs = True
 		self.player = self.bot.loop.create_task(self.player_task(), name = "Audio Player")
 		self.resume_flag = asyncio.Event()
 		self.not_interrupted = asyncio.Event()
@@ -51,6 +59,12 @@ class AudioPlayer:
 			if self.guild.voice_client.is_playing():
 				self.guild.voice_client.stop()
 			self.player.cancel()
+			for prefetch in self.prefetches.values():
+				prefetch.cancel()
+			self.prefetches.clear()
+			# Release cached files of queued songs, so they can be evicted
+			for song in self.queue._queue:
+				song.discard()
 			await self.guild.voice_client.disconnect()
 			return True
 	
@@ -58,6 +72,7 @@ class AudioPlayer:
 		source = YTDLSource(ctx, song, stream = stream)
 		await source.get_info()
 		await self.queue.put(source)
+		self.update_prefetches()
 		return source
 	
 	async def insert_song(self, ctx, song, position):
@@ -66,6 +81,7 @@ class AudioPlayer:
 		self.queue._queue.insert(position - 1, source)
 		await self.queue.put(None) # trigger get
 		self.queue._queue.pop()
+		self.update_prefetches()
 		return source
 	
 	async def player_task(self):
@@ -73,10 +89,13 @@ class AudioPlayer:
 		while True:
 			self.play_next_song.clear()
 			source = await self.queue.get()
+			self.update_prefetches()
 			await self.not_interrupted.wait()
 			if not source.stream:
 				now_playing_message = await self.bot.send_embed(self.text_channel, ":arrow_down: Downloading..", title = source.info.get("title", "N/A"), title_url = source.info.get("webpage_url"), timestamp = source.timestamp, footer_text = source.requester.display_name, footer_icon_url = source.requester.avatar_url, thumbnail_url = source.info.get("thumbnail"))
-			if not source.initialized: await source.initialize_source(self.default_volume)
+			if not source.initialized:
+				await source.initialize_source(self.default_volume, download = not self.stream_songs, 
+												cache = self.cache_streamed_songs)
 			self.guild.voice_client.play(source, after = self.after_song)
 			if source.stream:
 				await self.bot.send_embed(self.text_channel, ":arrow_forward: Now Playing", title = source.info.get("title", "N/A"), title_url = source.info.get("webpage_url"), timestamp = source.timestamp, footer_text = source.requester.display_name, footer_icon_url = source.requester.avatar_url, thumbnail_url = source.info.get("thumbnail"))
@@ -91,6 +110,50 @@ class AudioPlayer:
 			self.skip_votes.clear()
 			await self.play_next_song.wait()
 	
+	def update_prefetches(self):
+		'''
+		Start prefetching the next songs in the queue, and cancel prefetching songs no longer next
+		Cancelling only stops waiting for a download; one already running in the executor still finishes,
+		and is left in the audio cache
+		'''
+		upcoming = []
+		disk_budget = self.prefetch_disk_budget
+		# Streamed songs don't need to be downloaded in advance
+		prefetch_count = 0 if self.stream_songs else self.prefetch_count
+		for source in list(self.queue._queue)[:prefetch_count]:
+			if not isinstance(source, YTDLSource) or source.stream:
+				continue
+			size = source.info.get("filesize") or source.info.get("filesize_approx")
+			if size is None:
+				# Unknown size uses the rest of the budget
+				size = disk_budget
+			if size > disk_budget or not disk_budget:
+				break
+			disk_budget -= size
+			upcoming.append(source)
+		for source, prefetch in list(self.prefetches.items()):
+			if source not in upcoming:
+				prefetch.cancel()
+				del self.prefetches[source]
+		for source in upcoming:
+			if source not in self.prefetches and not source.filename:
+				prefetch = self.bot.loop.create_task(self.prefetch(source), name = "Audio Player prefetch")
+				prefetch.add_done_callback(functools.partial(self.prefetch_done, source))
+				self.prefetches[source] = prefetch
+	
+	def prefetch_done(self, source, prefetch):
+		# A cancelled prefetch can finish after a newer one for the same source has started
+		if self.prefetches.get(source) is prefetch:
+			del self.prefetches[source]
+	
+	async def prefetch(self, source):
+		async with self.prefetch_semaphore:
+			try:
+				await source.download()
+			except Exception as e:
+				# Download is retried when the song is played
+				traceback.print_exception(type(e), e, e.__traceback__)
+	
 	def after_song(self, error):
 		if error:
 			traceback.print_exception(type(error), error, error.__traceback__)
@@ -119,6 +182,8 @@ class AudioPlayer:
 		self.queue._queue.rotate(-(number - 1))
 		song = await self.queue.get()
 		self.queue._queue.rotate(number - 1)
+		song.discard()
+		self.update_prefetches()
 		return song
 	
 	async def skip_to_song(self, number):
@@ -127,6 +192,9 @@ class AudioPlayer:
 		songs = []
 		for i in range(number - 1):
 			songs.append(await self.queue.get())
+		for song in songs:
+			song.discard()
+		self.update_prefetches()
 		self.skip()
 		return songs
 	
@@ -138,6 +206,7 @@ class AudioPlayer:
 			self.guild.voice_client.source = duplicate
 		elif isinstance(duplicate, YTDLSource):
 			await self.queue.put(duplicate)
+			self.update_prefetches()
 		else:
 			self.skip()
 			await self.interrupt(duplicate)
@@ -161,7 +230,9 @@ class AudioPlayer:
 	async def empty_queue(self):
 		while not self.queue.empty():
 			song = await self.queue.get()
+			song.discard()
 			del song
+		self.update_prefetches()
 		# self.queue._queue.clear() ?
 	
 	async def shuffle_queue(self):
@@ -171,6 +242,7 @@ class AudioPlayer:
 		random.shuffle(song_list)
 		for song in song_list:
 			await self.queue.put(song)
+		self.update_prefetches()
 	
 	async def add_playlist(self, ctx, playlist):
 		response = await ctx.embed_reply(":cd: Loading..")
@@ -187,6 +259,7 @@ class AudioPlayer:
 					await self.bot.send_embed(self.text_channel, "{}: :warning: Error loading video {} (<{}>) from <{}>\n{}: {}".format(ctx.author.mention, position, "https://www.youtube.com/watch?v=" + video["id"], playlist, type(e).__name__, e))
 				except discord.HTTPException:
 					await self.bot.send_embed(self.text_channel, "{}: :warning: Error loading video {} (<{}>) from <{}>".format(ctx.author.mention, position, "https://www.youtube.com/watch?v=" + video["id"], playlist))
+		self.update_prefetches()
 		embed = response.embeds[0]
 		embed.description = ":ballot_box_with_check: Your songs have been added to the queue"
 		await response.edit(embed = embed)
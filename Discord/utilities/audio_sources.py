@@ -1,12 +1,92 @@
 
 import discord
 
+import asyncio
+import collections
 import functools
 import logging
 import shlex
 import subprocess
 import os
 
+class AudioCache:
+	
+	'''
+	Cache of downloaded audio files, shared between audio players
+	Files are named and keyed by extractor and video ID
+	Least recently used files that aren't in use are removed when over max_size bytes
+	'''
+	
+	def __init__(self, directory, max_size = 5 * 2 ** 30):
+		self.directory = directory
+		self.max_size = max_size
+		self.files = collections.OrderedDict()  # key: (filename, size)
+		self.references = collections.Counter()
+		self.downloads = {}
+		# Load files from previous sessions, least recently accessed first
+		if os.path.isdir(directory):
+			for entry in sorted(os.scandir(directory), key = lambda entry: entry.stat().st_atime):
+				if entry.is_file() and '-' in entry.name and not entry.name.endswith(".part"):
+					extractor_key, id = os.path.splitext(entry.name)[0].split('-', 1)
+					self.files[(extractor_key, id)] = (entry.path, entry.stat().st_size)
+	
+	@staticmethod
+	def key(info):
+		return (info.get("extractor_key") or info.get("extractor"), info["id"])
+	
+	@property
+	def size(self):
+		return sum(size for _, size in self.files.values())
+	
+	async def acquire(self, key, download):
+		'''
+		Get the filename for key, running download in an executor if not cached
+		download must return the filename
+		Files acquired must be released
+		'''
+		# Loop, as the file could be evicted before this resumes
+		while key not in self.files:
+			if key not in self.downloads:
+				self.downloads[key] = asyncio.get_event_loop().run_in_executor(None, download)
+				self.downloads[key].add_done_callback(functools.partial(self.downloaded, key))
+			# Shield so that cancelling one acquisition doesn't cancel the download for others
+			await asyncio.shield(self.downloads[key])
+		self.files.move_to_end(key)
+		self.references[key] += 1
+		self.evict()
+		return self.files[key][0]
+	
+	def downloaded(self, key, future):
+		del self.downloads[key]
+		if not future.cancelled() and not future.exception():
+			filename = future.result()
+			self.files[key] = (filename, os.path.getsize(filename))
+	
+	def release(self, key):
+		self.references[key] -= 1
+		if self.references[key] <= 0:
+			del self.references[key]
+		self.evict()
+	
+	def evict(self):
+		size = self.size
+		for key, (filename, file_size) in list(self.files.items()):
+			if size <= self.max_size:
+				break
+			if self.references[key]:
+				continue
+			try:
+				os.remove(filename)
+			except FileNotFoundError:
+				pass
+			except PermissionError as e:
+				# File may still be open, e.g. by FFmpeg on Windows; retried on next eviction
+				logging.getLogger("errors").warning(f"Failed to remove cached audio file: {e}")
+				continue
+			del self.files[key]
+			size -= file_size
+
+
 class ModifiedFFmpegPCMAudio(discord.FFmpegPCMAudio):
 	
 	'''
@@ -14,6 +94,9 @@ class ModifiedFFmpegPCMAudio(discord.FFmpegPCMAudio):
 	To use ffmpeg log as stderr
 	'''
 	
+	# Reconnect to dropped HTTP connections when streaming from a URL
+	reconnect_options = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+	
 	def __init__(self, ctx, source, before_options = None):
 		self.ctx = ctx
 		self.source = source  # Unnecessary?
@@ -134,7 +217,10 @@ class YTDLSource(ModifiedPCMVolumeTransformer):
 		self.title = title_prefix
 		
 		self.initialized = False
+		self.download_lock = asyncio.Lock()
+		self.cache_key = None
 		self.filename = None
+		self.cache_download = None
 		self.previous_played_time = 0
 	
 	async def get_info(self):
@@ -150,17 +236,57 @@ class YTDLSource(ModifiedPCMVolumeTransformer):
 		self.stream = self.info.get("is_live") or self.stream
 		if "title" in self.info: self.title += "`{}`".format(self.info["title"])
 	
-	async def initialize_source(self, volume):
+	async def download(self):
+		# Locked, as shared between prefetching and initialization
+		async with self.download_lock:
+			if self.filename:
+				return
+			key = self.bot.audio_cache.key(self.info)
+			self.filename = await self.bot.audio_cache.acquire(key, self.download_file)
+			self.cache_key = key
+	
+	def download_file(self):
+		info = self.bot.ytdl_download.extract_info(self.info["webpage_url"], download = True)
+		return self.bot.ytdl_download.prepare_filename(info)
+	
+	def discard(self):
+		'''
+		Release the cached file of a source that won't be played
+		Must be called on the event loop
+		'''
+		if self.cache_download:
+			# The file is still downloaded to the cache for others, but without a reference
+			self.cache_download.cancel()
+			self.cache_download = None
+		if self.filename:
+			self.bot.audio_cache.release(self.cache_key)
+			self.filename = None
+	
+	async def initialize_source(self, volume, *, download = True, cache = True):
+		'''
+		Play from the downloaded file, or with download = False, stream from the media URL
+		cache: Whether to download the file to the cache in the background while streaming
+		'''
 		if self.stream:
-			super().__init__(ModifiedFFmpegPCMAudio(self.ctx, self.info["url"]), volume)
+			super().__init__(ModifiedFFmpegPCMAudio(self.ctx, self.info["url"], 
+													before_options = ModifiedFFmpegPCMAudio.reconnect_options), volume)
 		else:
-			func = functools.partial(self.bot.ytdl_download.extract_info, self.info["webpage_url"], download = True)
-			info = await self.bot.loop.run_in_executor(None, func)
-			self.filename = self.bot.ytdl_download.prepare_filename(info)
-			
-			before_options = "-ss {}".format(self.info["start_time"]) if self.info.get("start_time") else None
+			if download or self.bot.audio_cache.key(self.info) in self.bot.audio_cache.files:
+				# If the cached file is evicted while waiting for a prefetch to release the download lock, 
+				# it's downloaded again before playing, as with download = True
+				await self.download()
+				media = self.filename
+				before_options = []
+			else:
+				media = self.info["url"]
+				before_options = [ModifiedFFmpegPCMAudio.reconnect_options]
+				if cache:
+					self.cache_download = self.bot.loop.create_task(self.download(), 
+																	name = "YTDL Source cache download")
+			if self.info.get("start_time"):
+				before_options.append("-ss {}".format(self.info["start_time"]))
 			self.previous_played_time = self.info.get("start_time") if self.info.get("start_time") else 0
-			super().__init__(ModifiedFFmpegPCMAudio(self.ctx, self.filename, before_options = before_options), volume)
+			super().__init__(ModifiedFFmpegPCMAudio(self.ctx, media, before_options = ' '.join(before_options) or None), volume)
 		self.initialized = True
 	
 	@classmethod
@@ -172,9 +298,7 @@ class YTDLSource(ModifiedPCMVolumeTransformer):
 	
 	def cleanup(self):
 		if self.initialized: super().cleanup()
-		if self.filename and os.path.exists(self.filename):
-			try:
-				os.remove(self.filename)
-			except PermissionError as e:  # TODO: Fix
-				print(str(e))
+		# Called from the voice thread and on garbage collection, so release on the event loop
+		if not self.bot.loop.is_closed():
+			self.bot.loop.call_soon_threadsafe(self.discard)
 
@@ -58,21 +58,15 @@ class Context(commands.Context):
 	def whisper(self, *args, **kwargs):
 		return self.author.send(*args, **kwargs)
 	
-	# TODO: Improve
 	async def get_permission(self, permission, *, type = "user", user = None, id = None):
 		if not self.guild:
 			return True
+		guild_permissions = await self.bot.get_guild_permissions(self.guild.id)
 		role_ids = []
 		if type == "user":
 			if user:
 				id = user.id
-			user_setting  = await self.bot.db.fetchval(
-				"""
-				SELECT setting FROM permissions.users
-				WHERE guild_id = $1 AND user_id = $2 AND permission = $3
-				""", 
-				self.guild.id, id, permission
-			)
+			user_setting = guild_permissions["users"].get((id, permission))
 			if user_setting is not None:
 				return user_setting
 			if not user:
@@ -81,20 +75,15 @@ class Context(commands.Context):
 		elif type == "role":
 			role_ids.append(id)
 		for role_id in role_ids:
-			role_setting = await self.bot.db.fetchval(
-				"""
-				SELECT setting FROM permissions.roles
-				WHERE guild_id = $1 AND role_id = $2 AND permission = $3
-				""", 
-				self.guild.id, role_id, permission
-			)
+			role_setting = guild_permissions["roles"].get((role_id, permission))
 			if role_setting is not None:
 				return role_setting
-		return await self.bot.db.fetchval(
-			"""
-			SELECT setting FROM permissions.everyone
-			WHERE guild_id = $1 AND permission = $2
-			""", 
-			self.guild.id, permission
-		)
+		return guild_permissions["everyone"].get(permission)
+	
+	async def get_command_permission(self, command, **kwargs):
+		# Fall back to parent commands
+		while ((permitted := await self.get_permission(command.name, **kwargs)) is None
+				and command.parent is not None):
+			command = command.parent
+		return permitted
 
@@ -1,6 +1,9 @@
 
+import asyncio
+import collections
 import contextlib
 import json
+import logging
 import os
 import sys
 
@@ -38,3 +41,126 @@ async def initialize_database_connection(connection):
 		schema = "pg_catalog"
 	)
 
+
+class BatchedRecordWriter:
+	
+	'''
+	Write-behind buffer for database records
+	Records are written in bulk by write, a coroutine function that's passed the buffered records,
+	when batch_size records are buffered or every flush_interval seconds
+	Adding records waits for a flush when max_buffer_size records are buffered
+	'''
+	
+	def __init__(self, write, *, name = "records", batch_size = 500, flush_interval = 5, 
+					max_buffer_size = 10000):
+		self.write = write
+		self.name = name
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_buffer_size = max_buffer_size
+		self.buffer = []
+		self.flush_lock = asyncio.Lock()
+		self.flush_needed = asyncio.Event()
+		self.task = None
+	
+	def start(self, loop = None):
+		loop = loop or asyncio.get_event_loop()
+		self.task = loop.create_task(self.flush_periodically(), name = f"Write buffered {self.name}")
+	
+	async def add(self, record):
+		if len(self.buffer) >= self.max_buffer_size:
+			# Backpressure
+			await self.flush()
+			if len(self.buffer) >= self.max_buffer_size:
+				# Flush failed; drop oldest record
+				del self.buffer[0]
+		self.buffer.append(record)
+		if len(self.buffer) >= self.batch_size:
+			self.flush_needed.set()
+	
+	async def flush_periodically(self):
+		while True:
+			with contextlib.suppress(asyncio.TimeoutError):
+				await asyncio.wait_for(self.flush_needed.wait(), timeout = self.flush_interval)
+			self.flush_needed.clear()
+			await self.flush()
+	
+	async def flush(self):
+		async with self.flush_lock:
+			if not self.buffer:
+				return
+			records, self.buffer = self.buffer, []
+			try:
+				await self.write(records)
+			except Exception:
+				logging.getLogger("errors").exception(f"Failed to write {len(records)} buffered {self.name}\n")
+				# Requeue records, keeping the most recent if buffer is full
+				self.buffer[:0] = records
+				del self.buffer[:-self.max_buffer_size]
+	
+	async def close(self):
+		if self.task:
+			# Wait for a flush in progress, so its swapped out records aren't lost by cancelling it
+			async with self.flush_lock:
+				self.task.cancel()
+			with contextlib.suppress(asyncio.CancelledError):
+				await self.task
+			self.task = None
+		await self.flush()
+
+
+class BufferedCounter:
+	
+	'''
+	Write-behind buffer for database counters
+	Increments are coalesced by key and written by write, a coroutine function that's passed
+	a collections.Counter of the buffered increments, every flush_interval seconds
+	write_sequence is incremented when a write starts and when it ends, so is odd while one is in progress
+	'''
+	
+	def __init__(self, write, *, name = "counts", flush_interval = 10):
+		self.write = write
+		self.name = name
+		self.flush_interval = flush_interval
+		self.counts = collections.Counter()
+		self.flush_lock = asyncio.Lock()
+		self.write_sequence = 0
+		self.task = None
+	
+	def start(self, loop = None):
+		loop = loop or asyncio.get_event_loop()
+		self.task = loop.create_task(self.flush_periodically(), name = f"Write buffered {self.name}")
+	
+	def increment(self, key, amount = 1):
+		self.counts[key] += amount
+	
+	async def flush_periodically(self):
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			await self.flush()
+	
+	async def flush(self):
+		async with self.flush_lock:
+			if not self.counts:
+				return
+			counts, self.counts = self.counts, collections.Counter()
+			self.write_sequence += 1
+			try:
+				await self.write(counts)
+			except Exception:
+				logging.getLogger("errors").exception(f"Failed to write buffered {self.name}\n")
+				# Merge increments back to keep counts exact
+				self.counts.update(counts)
+			finally:
+				self.write_sequence += 1
+	
+	async def close(self):
+		if self.task:
+			# Wait for a flush in progress, so its swapped out counts aren't lost by cancelling it
+			async with self.flush_lock:
+				self.task.cancel()
+			with contextlib.suppress(asyncio.CancelledError):
+				await self.task
+			self.task = None
+		await self.flush()
+
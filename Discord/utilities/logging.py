@@ -7,7 +7,7 @@ import sys
 
 from aiohttp.web_log import AccessLogger
 
-from utilities.database import create_database_connection
+from utilities.database import BatchedRecordWriter
 
 sys.path.insert(0, "..")
 from units.files import create_folder
@@ -114,24 +114,20 @@ def initialize_logging(data_path):
 
 class AiohttpAccessLogger(AccessLogger):
 	
+	# Set by initialize_aiohttp_access_logging
+	record_writer = None
+	
 	def log(self, request, response, time):
 		# super().log(request, response, time)
-		asyncio.create_task(self.log_to_database(request, response, time), name = "Log aiohttp access to database")
-	
-	async def log_to_database(self, request, response, time):
-		async with create_database_connection() as connection:
-			await connection.execute(
-				"""
-				INSERT INTO aiohttp.access_log
-				VALUES ($1, $2, $3, $4, $5, $6, $7)
-				""", 
-				datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds = time), 
-				self._format_a(request, response, time), 
-				self._format_r(request, response, time), 
-				response.status, response.body_length, 
-				self._format_i("Referer", request, response, time), 
-				self._format_i("User-Agent", request, response, time).encode("UTF-8", "backslashreplace").decode("UTF-8")
-			)
+		record = (
+			datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds = time), 
+			self._format_a(request, response, time), 
+			self._format_r(request, response, time), 
+			response.status, response.body_length, 
+			self._format_i("Referer", request, response, time), 
+			self._format_i("User-Agent", request, response, time).encode("UTF-8", "backslashreplace").decode("UTF-8")
+		)
+		asyncio.create_task(self.record_writer.add(record), name = "Log aiohttp access to database")
 
 
 async def initialize_aiohttp_access_logging(database):
@@ -139,7 +135,8 @@ async def initialize_aiohttp_access_logging(database):
 	await database.execute(
 		"""
 		CREATE TABLE IF NOT EXISTS aiohttp.access_log (
-			request_start_timestamp		TIMESTAMPTZ PRIMARY KEY, 
+			request_id					BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY, 
+			request_start_timestamp		TIMESTAMPTZ, 
 			remote_ip_address			TEXT, 
 			request_first_line			TEXT, 
 			response_status_code		INT, 
@@ -149,4 +146,33 @@ async def initialize_aiohttp_access_logging(database):
 		)
 		"""
 	)
+	# Migrate primary key from request_start_timestamp, which can collide, to request_id
+	await database.execute(
+		"""
+		DO $$
+		BEGIN
+			IF NOT EXISTS (
+				SELECT FROM information_schema.columns
+				WHERE table_schema = 'aiohttp' AND table_name = 'access_log' AND column_name = 'request_id'
+			) THEN
+				ALTER TABLE aiohttp.access_log DROP CONSTRAINT access_log_pkey;
+				ALTER TABLE aiohttp.access_log ADD COLUMN request_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY;
+			END IF;
+		END $$
+		"""
+	)
+	
+	async def write_access_log_records(records):
+		async with database.acquire() as connection:
+			await connection.copy_records_to_table(
+				"access_log", schema_name = "aiohttp", records = records, 
+				columns = ("request_start_timestamp", "remote_ip_address", "request_first_line", 
+							"response_status_code", "response_bytes_size", 
+							"request_referer", "request_user_agent")
+			)
+	
+	AiohttpAccessLogger.record_writer = BatchedRecordWriter(write_access_log_records, 
+															name = "aiohttp access log records", 
+															batch_size = 100)
+	AiohttpAccessLogger.record_writer.start()
 
@@ -0,0 +1,153 @@
+
+import asyncio
+import logging
+import multiprocessing
+import pickle
+
+try:
+	import resource
+except ImportError:  # Windows
+	resource = None
+
+errors_logger = logging.getLogger("errors")
+
+class WorkerError(Exception):
+	'''Worker process crashed or couldn't be started'''
+	pass
+
+def worker_main(connection, memory_limit, initializer):
+	'''Run tasks received through connection until it's closed'''
+	if memory_limit and resource:
+		resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+	if initializer:
+		initializer()
+	while True:
+		try:
+			func, args, kwargs = connection.recv()
+		except EOFError:
+			return
+		try:
+			result = ("result", func(*args, **kwargs))
+		except Exception as e:
+			try:
+				# Some exceptions can be pickled, but not unpickled
+				pickle.loads(pickle.dumps(e))
+				result = ("error", e)
+			except Exception:
+				result = ("error", RuntimeError(f"{type(e).__name__}: {e}"))
+		try:
+			connection.send(result)
+		except Exception as e:
+			# Unpicklable result
+			connection.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+class WorkerPool:
+	
+	'''
+	Pool of persistent worker processes, for running functions with a time limit
+	Workers are only killed and replaced when they exceed the time limit, run out of memory, or crash
+	memory_limit: Maximum address space of each worker, in bytes, where supported
+	initializer: Called when each worker starts, e.g. to import modules in advance
+	func, arguments, and results must be picklable
+	'''
+	
+	def __init__(self, size = 1, *, memory_limit = None, initializer = None):
+		self.size = size
+		self.memory_limit = memory_limit
+		self.initializer = initializer
+		# Spawn, so workers don't inherit the bot's memory and state
+		self.context = multiprocessing.get_context("spawn")
+		self.idle = asyncio.Queue()
+		self.closed = False
+	
+	def start(self):
+		for _ in range(self.size):
+			self.idle.put_nowait(self.start_worker())
+	
+	def start_worker(self):
+		connection, worker_connection = self.context.Pipe()
+		process = self.context.Process(target = worker_main, 
+										args = (worker_connection, self.memory_limit, self.initializer), 
+										daemon = True)
+		process.start()
+		worker_connection.close()
+		return process, connection
+	
+	def restart_worker(self, process, connection):
+		process.kill()
+		process.join()
+		connection.close()
+		return self.start_worker()
+	
+	async def run(self, timeout, func, *args, **kwargs):
+		'''
+		Run func in a worker process
+		Raises asyncio.TimeoutError if it takes longer than timeout seconds
+		Raises WorkerError if the worker process crashes, or a replacement can't be started
+		Exceptions raised by func are re-raised
+		'''
+		loop = asyncio.get_running_loop()
+		process, connection = await self.get_worker()
+		replace = True
+		try:
+			try:
+				await loop.run_in_executor(None, connection.send, (func, args, kwargs))
+				if not await loop.run_in_executor(None, connection.poll, timeout):
+					raise asyncio.TimeoutError
+				status, result = connection.recv()
+			except (EOFError, OSError) as e:
+				# Worker exited while running func
+				raise WorkerError("Worker process crashed") from e
+			# The worker may be in a bad state after running out of memory
+			replace = status == "error" and isinstance(result, MemoryError)
+		finally:
+			if self.closed:
+				process.kill()
+				connection.close()
+			elif replace:
+				self.replace_worker(process, connection)
+			else:
+				self.idle.put_nowait((process, connection))
+		if status == "error":
+			raise result
+		return result
+	
+	async def get_worker(self):
+		worker = await self.idle.get()
+		if worker is None:
+			# Replacing a worker failed, so retry starting one
+			try:
+				worker = await asyncio.get_running_loop().run_in_executor(None, self.start_worker)
+			except Exception as e:
+				self.idle.put_nowait(None)
+				raise WorkerError("Failed to start worker process") from e
+		return worker
+	
+	def replace_worker(self, process, connection):
+		future = asyncio.get_running_loop().run_in_executor(None, self.restart_worker, process, connection)
+		future.add_done_callback(self.worker_replaced)
+	
+	def worker_replaced(self, future):
+		if future.cancelled():
+			return
+		if exception := future.exception():
+			errors_logger.error("Failed to replace worker process", exc_info = exception)
+			if not self.closed:
+				# Keep the slot, to be retried by the next run
+				self.idle.put_nowait(None)
+		elif self.closed:
+			process, connection = future.result()
+			process.kill()
+			connection.close()
+		else:
+			self.idle.put_nowait(future.result())
+	
+	def close(self):
+		self.closed = True
+		while not self.idle.empty():
+			if worker := self.idle.get_nowait():
+				process, connection = worker
+				process.kill()
+				connection.close()
+
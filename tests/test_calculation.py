@@ -1,14 +1,17 @@
 
 import unittest
 
+import concurrent.futures
 import math
+import os
+import timeit
 
 from hypothesis import assume, given
 from hypothesis.strategies import characters, integers, lists, text
 
 import pyparsing
 
-from units.calculation import calculate
+from units.calculation import calculate, compile_expression, evaluate
 
 class TestCalculate(unittest.TestCase):
 	
@@ -98,4 +101,31 @@ class TestCalculate(unittest.TestCase):
 	@given(integers(min_value = 0))
 	def test_division_by_zero(self, dividend):
 		self.assertRaises(ZeroDivisionError, calculate, f"{dividend}/0")
+	
+	@given(lists(integers(min_value = 0), min_size = 2))
+	def test_concurrent(self, numbers):
+		expressions = [f"{number}+{number}*({number}-{number})" for number in numbers]
+		with concurrent.futures.ThreadPoolExecutor(max_workers = 4) as executor:
+			self.assertEqual(list(executor.map(calculate, expressions)), numbers)
+	
+	@given(integers(min_value = 0), integers(min_value = 1))
+	def test_compiled_reuse(self, operand_1, operand_2):
+		code = compile_expression(f"({operand_1}+{operand_2})/{operand_2}")
+		for _ in range(3):
+			self.assertEqual(evaluate(code), (operand_1 + operand_2) / operand_2)
+
+@unittest.skipUnless(os.getenv("RUN_BENCHMARKS"), "Timing comparisons are only run when RUN_BENCHMARKS is set")
+class BenchmarkCalculate(unittest.TestCase):
+	
+	expression = "(12+34)*56-78/(9+10)*(11-12)+13*14"
+	number = 1000
+	
+	def test_compiled_evaluation(self):
+		parse_and_evaluate = lambda: evaluate(compile_expression.__wrapped__(self.expression))
+		code = compile_expression(self.expression)
+		parsing_time = timeit.timeit(parse_and_evaluate, number = self.number)
+		evaluation_time = timeit.timeit(lambda: evaluate(code), number = self.number)
+		cached_time = timeit.timeit(lambda: calculate(self.expression), number = self.number)
+		self.assertLess(evaluation_time, parsing_time)
+		self.assertLess(cached_time, parsing_time)
 
@@ -1,42 +1,49 @@
+import ast
+import functools
 
-import operator
+from pyparsing import Forward, Literal, nums, Suppress, Word
 
-from pyparsing import Forward, Group, Literal, nums, Suppress, Word
+operators = {
+	'+': ast.Add,
+	'-': ast.Sub,
+	'*': ast.Mult,
+	'/': ast.Div
+}
 
-expression_stack = []
+def number_node(tokens):
+	return ast.Constant(int(tokens[0]))
 
-def push_first(tokens):
-	expression_stack.append(tokens[0])
+def binary_operation_node(tokens):
+	# Left associative
+	node = tokens[0]
+	for operator_token, operand in zip(tokens[1::2], tokens[2::2]):
+		node = ast.BinOp(node, operators[operator_token](), operand)
+	return node
 
 """
 atom       :: '0'..'9'+ | '(' expression ')'
 term       :: atom [ ('*' | '/') atom ]*
 expression :: term [ ('+' | '-') term ]*
 """
+# Parse actions build a Python expression AST, so parsing has no shared state
 expression = Forward()
-atom = (Word(nums)).setParseAction(push_first) | Group(Suppress('(') + expression + Suppress(')'))
-term = atom + ((Literal('*') | Literal('/')) + atom).setParseAction(push_first)[...]
-expression <<= term + ((Literal('+') | Literal('-')) + term).setParseAction(push_first)[...]
-
-operations = {
-	'+': operator.add,
-	'-': operator.sub,
-	'*': operator.mul,
-	'/': operator.truediv
-}
-
-def evaluate_stack(stack):
-	token = stack.pop()
-	if token in "+-*/":
-		# Operands are pushed onto the stack in reverse order
-		operand_2 = evaluate_stack(stack)
-		operand_1 = evaluate_stack(stack)
-		return operations[token](operand_1, operand_2)
-	else:
-		return int(token)
+atom = (Word(nums)).setParseAction(number_node) | Suppress('(') + expression + Suppress(')')
+term = (atom + ((Literal('*') | Literal('/')) + atom)[...]).setParseAction(binary_operation_node)
+expression <<= (term + ((Literal('+') | Literal('-')) + term)[...]).setParseAction(binary_operation_node)
+
+@functools.lru_cache(maxsize = 1024)
+def compile_expression(input_string: str):
+	'''
+	Parse input_string into a code object, to be evaluated with evaluate
+	Can be evaluated any number of times, concurrently
+	'''
+	node = expression.parseString(input_string, parseAll=True)[0]  # can raise pyparsing.ParseException
+	return compile(ast.fix_missing_locations(ast.Expression(body = node)), "<calculation>", "eval")
+
+def evaluate(code):
+	# Only the operators in the grammar can appear in code, so no names are needed
+	return eval(code, {"__builtins__": {}})  # can raise ZeroDivisionError
 
 def calculate(input_string: str):
-	expression_stack.clear()
-	expression.parseString(input_string, parseAll=True)  # can raise pyparsing.ParseException
-	return evaluate_stack(expression_stack)  # can raise ZeroDivisionError
+	return evaluate(compile_expression(input_string))
 